@@ -43,7 +43,11 @@ def create_app(config_name: str = "development") -> Flask:
     CORS(app,
          supports_credentials=True,
          methods=["GET", "POST", "PUT", "DELETE"],
-         allow_headers=["Content-Type", "Authorization", "X-Requested-With"])
+         allow_headers=["Content-Type", "Authorization", "X-Requested-With",
+                        # upload-chunk 的 application/octet-stream 请求把参数放在 X-Upload-<参数名> 头里
+                        "X-Upload-historyId", "X-Upload-fileId", "X-Upload-fileName", "X-Upload-folderType",
+                        "X-Upload-chunkIndex", "X-Upload-chunkSize", "X-Upload-fileSize",
+                        "X-Upload-md5", "X-Upload-chunkMd5"])
     mongo.init_app(app, tls=True, tlsCAFile=certifi.where())
     jwt.init_app(app)
     print("MongoDB connected:", mongo.db is not None)
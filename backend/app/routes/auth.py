@@ -34,6 +34,15 @@ import signal
 import builtins
 import base64
 import traceback
+import threading
+import time
+from utils import LRUCache, PRECISIONS, CpuPlacement, CpuPlacementPolicy, EpochTimer, prepare_device, prepare_precision
+from onnx_backend import INFERENCE_BACKENDS
+from quantization import QUANTIZATION_MODES
+from models import GeneratorSR, ResnetGenerator
+from checkpoints import checkpoint_entry
+from model_registry import ModelRegistry
+from inference import load_inference_generator
 
 
 
@@ -341,6 +350,147 @@ def reset_password():
 # ================== upoad  ==================
 def _ensure(p): os.makedirs(p, exist_ok=True)
 def _has_tiff(f): return any(x.lower().endswith(('.tif','.tiff')) for x in os.listdir(f))
+def _tmp_name(p): return f'{p}.tmp-{os.getpid()}-{threading.get_ident()}'
+
+def _write_text_atomic(path, text):
+    tmp = _tmp_name(path)
+    with open(tmp, 'w') as f: f.write(text)
+    os.replace(tmp, path)
+
+def _chunk_dir(uid, history_id, folder_tp, file_id):
+    """tmp_<lr|hr>/<fileId> 目录；参数非法时返回 None（防止路径穿越）"""
+    if not re.match(r'^history_\d+$', history_id or '') or folder_tp not in ('lr', 'hr') \
+            or not file_id or os.path.basename(file_id) != file_id or file_id in ('.', '..'):
+        return None
+    uname = mongo.db.users.find_one({'_id': ObjectId(uid)})['username']
+    return os.path.join(current_app.config['UPLOAD_ROOT'], uname, history_id, f'tmp_{folder_tp}', file_id)
+
+def _received_chunks(tmp_dir):
+    """已完整落盘的分片 {index: (md5, bytes)}，来自每片写完后才落下的 <n>.md5 记录"""
+    if not os.path.isdir(tmp_dir):
+        return {}
+    chunks = {}
+    for f in os.listdir(tmp_dir):
+        if f.endswith('.md5') and f[:-4].isdigit():
+            with open(os.path.join(tmp_dir, f)) as fp:
+                digest, size = fp.read().split()
+            chunks[int(f[:-4])] = (digest, int(size))
+    return chunks
+
+def _read_layout(tmp_dir):
+    """原地写模式的 {chunk_size, file_size}；旧的 .part 模式返回 None"""
+    path = os.path.join(tmp_dir, '_layout.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _iter_chunk(tmp_dir, idx, size, layout, blk_size=8*1024*1024):
+    """读回已落盘的第 idx 片（原地写模式从 _data 的 idx*chunk_size 处，否则从 <n>.part）"""
+    if layout:
+        path, offset = os.path.join(tmp_dir, '_data'), idx * layout['chunk_size']
+    else:
+        path, offset = os.path.join(tmp_dir, f'{idx:05d}.part'), 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            blk = f.read(min(blk_size, size))
+            if not blk:
+                raise IOError(f'chunk {idx} is truncated')
+            size -= len(blk)
+            yield blk
+
+# 每个上传的整文件 md5：按分片顺序推进，分片落盘后由后台线程把与已哈希前缀相连的部分算进去，
+# 上传请求本身不读回数据，merge 时也不必再把整个文件读一遍。状态只在本进程内，重启后 merge 会从头补算。
+_running_md5 = {}
+_running_md5_lock = threading.Lock()
+_md5_workers = {}            # tmp_dir -> 正在推进该文件 md5 的后台线程
+_md5_pending = set()         # 线程运行期间又有新分片落盘的 tmp_dir
+
+def _advance_md5(tmp_dir):
+    """把紧接已哈希前缀、且已落盘的分片并入运行中的 md5，返回 (state, 已哈希的分片数)"""
+    with _running_md5_lock:
+        state = _running_md5.setdefault(tmp_dir, {'md5': hashlib.md5(), 'next': 0, 'lock': threading.Lock()})
+    with state['lock']:
+        chunks = _received_chunks(tmp_dir)
+        layout = _read_layout(tmp_dir)
+        while state['next'] in chunks:
+            idx = state['next']
+            for blk in _iter_chunk(tmp_dir, idx, chunks[idx][1], layout):
+                state['md5'].update(blk)
+            state['next'] += 1
+        return state, state['next']
+
+def _md5_worker(tmp_dir):
+    while True:
+        try:
+            if os.path.isdir(tmp_dir):           # merge 之后目录已删除，不再建新状态
+                _advance_md5(tmp_dir)
+        except OSError as e:
+            print(f"running md5 of {tmp_dir} stopped: {e}")
+        with _running_md5_lock:
+            if tmp_dir not in _md5_pending:
+                _md5_workers.pop(tmp_dir, None)
+                return
+            _md5_pending.discard(tmp_dir)
+
+def _schedule_md5(tmp_dir):
+    """在后台推进 tmp_dir 的运行 md5；已有线程在跑时只做标记，由它结束前再推进一轮"""
+    with _running_md5_lock:
+        if tmp_dir in _md5_workers:
+            _md5_pending.add(tmp_dir)
+            return
+        worker = _md5_workers[tmp_dir] = threading.Thread(target=_md5_worker, args=(tmp_dir,), daemon=True)
+    worker.start()
+
+def _invalidate_chunk(tmp_dir, idx):
+    """重传第 idx 片前调用：删掉它的摘要记录，已哈希过它的运行 md5 作废"""
+    try:
+        os.remove(os.path.join(tmp_dir, f'{idx:05d}.md5'))
+    except FileNotFoundError:
+        pass
+    with _running_md5_lock:
+        state = _running_md5.get(tmp_dir)
+        if state is not None and state['next'] > idx:
+            _running_md5.pop(tmp_dir)
+
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+def _iter_stream(stream, buf_size=UPLOAD_BUFFER_SIZE):
+    """按固定大小的缓冲区读取上传数据；支持 readinto 时复用同一块缓冲区（每块须在下次迭代前用完）"""
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is None:
+        yield from iter(lambda: stream.read(buf_size), b'')
+        return
+    view = memoryview(bytearray(buf_size))
+    while True:
+        n = readinto(view)
+        if not n:
+            return
+        yield view[:n]
+
+def _copy_into(src_path, out_fd, blk_size=8*1024*1024):
+    """把 src 追加写到 out_fd：优先 os.copy_file_range（内核内拷贝，同一文件系统上可零拷贝），不支持时退回读写"""
+    with open(src_path, 'rb', buffering=0) as in_f:
+        in_fd = in_f.fileno()
+        remaining = os.fstat(in_fd).st_size
+        zero_copy = hasattr(os, 'copy_file_range')
+        while remaining > 0:
+            n = 0
+            if zero_copy:
+                try:
+                    n = os.copy_file_range(in_fd, out_fd, remaining)
+                except OSError:
+                    zero_copy = False
+            if n == 0:
+                blk = os.read(in_fd, min(blk_size, remaining))
+                if not blk:
+                    raise IOError(f'{src_path} is truncated')
+                view = memoryview(blk)
+                while view:
+                    view = view[os.write(out_fd, view):]
+                n = len(blk)
+            remaining -= n
 
 # ================== 1. new-history ==================
 @auth_bp.route('/new-history', methods=['POST'])
@@ -361,45 +511,162 @@ def new_history():
     return jsonify({'history_id': hid}), 201
 
 # ================== 2. upload-chunk ==================
-@auth_bp.route('/upload-chunk', methods=['POST'])
+# 分片可以乱序、并行上传；每片边收边算 md5，先写临时文件再 rename，中断后不会留下半个分片
+# 两种请求格式：
+#   multipart/form-data：参数在表单里，数据在 'chunk' 文件字段（Werkzeug 会先落一份临时文件）
+#   application/octet-stream：请求体就是分片数据，参数放在 query string 或 X-Upload-<参数名> 头里，
+#       数据从 request.stream 直接写到最终位置，只写一次
+@auth_bp.route('/upload-chunk', methods=['POST', 'PUT'])
 @jwt_required()
 def upload_chunk():
-    history_id = request.form.get('historyId')
-    file_id    = request.form.get('fileId')
-    file_name  = request.form.get('fileName')
-    folder_tp  = request.form.get('folderType')          # 'lr' | 'hr'
+    raw = request.mimetype == 'application/octet-stream'
+    if raw:
+        param = lambda name, default=None: request.args.get(name) or request.headers.get(f'X-Upload-{name}', default)
+    else:
+        param = request.form.get
+    history_id = param('historyId')
+    file_id    = param('fileId')
+    file_name  = param('fileName')
+    folder_tp  = param('folderType')                     # 'lr' | 'hr'
     try:
-        idx = int(request.form.get('chunkIndex', -1))
+        idx = int(param('chunkIndex', -1))
     except (TypeError, ValueError):
         idx = -1
-    chunk   = request.files.get('chunk')
-    md5_end = request.form.get('md5')                    
+    chunk   = request.stream if raw else request.files.get('chunk')
+    stream  = chunk if raw else (chunk.stream if chunk else None)
+    md5_end = param('md5')                               # 整个文件的 md5（merge 时校验）
+    chunk_md5 = param('chunkMd5')                        # 本分片的 md5（可选，收到后立即校验）
+    try:
+        # 可选：给出分片大小和文件总大小时，分片直接写到目标文件的 idx*chunkSize 处，merge 无需再拼接
+        chunk_size = int(param('chunkSize', 0))
+        file_size  = int(param('fileSize', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'invalid chunkSize / fileSize'}), 400
 
     # ---------- check ----------
     print("DEBUG upload_chunk:",
           history_id, file_id, file_name, folder_tp,
           "chunk?", chunk is not None,
-          "idx=", request.form.get('chunkIndex'))
+          "idx=", idx, "raw" if raw else "multipart")
 
     if not all([history_id, file_id, file_name, folder_tp, chunk]) or idx < 0:
         return jsonify({'error': 'missing params'}), 400
 
-    uid   = get_jwt_identity()
-    uname = mongo.db.users.find_one({'_id': ObjectId(uid)})['username']
-    base  = os.path.join(current_app.config['UPLOAD_ROOT'], uname)
-    tmp_dir = os.path.join(base, history_id, f'tmp_{folder_tp}', file_id)
+    tmp_dir = _chunk_dir(get_jwt_identity(), history_id, folder_tp, file_id)
+    if tmp_dir is None:
+        return jsonify({'error': 'invalid params'}), 400
     _ensure(tmp_dir)
+    # 第一片到达时创建 _started（其 mtime 即开始时间），用于 upload-status 统计吞吐
+    try:
+        open(os.path.join(tmp_dir, '_started'), 'x').close()
+    except FileExistsError:
+        pass
 
-    chunk.save(os.path.join(tmp_dir, f'{idx:05d}.part'))
+    h = hashlib.md5()
+    received = 0
+    start = time.perf_counter()
+    if chunk_size > 0 and file_size > 0:
+        # ---- 原地写：预分配 _data，pwrite 到本片的偏移 ----
+        offset = idx * chunk_size
+        expected = min(chunk_size, file_size - offset)
+        if expected <= 0:
+            return jsonify({'error': f'chunk {idx} is beyond fileSize'}), 400
+        layout = {'chunk_size': chunk_size, 'file_size': file_size}
+        if _read_layout(tmp_dir) is None:
+            _write_text_atomic(os.path.join(tmp_dir, '_layout.json'), json.dumps(layout))
+        if _read_layout(tmp_dir) != layout:
+            return jsonify({'error': 'chunkSize / fileSize differ from earlier chunks'}), 400
+
+        # 校验通过后、写入前撤掉本片的摘要记录（重传时），写入期间它不算已收到，运行 md5 也不会读到写了一半的数据
+        _invalidate_chunk(tmp_dir, idx)
+        fd = os.open(os.path.join(tmp_dir, '_data'), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < file_size:
+                try:
+                    os.posix_fallocate(fd, 0, file_size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, file_size)
+            for blk in _iter_stream(stream):
+                if received + len(blk) > expected:
+                    return jsonify({'error': f'chunk {idx} is larger than {expected} bytes'}), 400
+                h.update(blk)
+                view = memoryview(blk)
+                while view:
+                    view = view[os.pwrite(fd, view, offset + received + len(blk) - len(view)):]
+                received += len(blk)
+        finally:
+            os.close(fd)
+        if received != expected:
+            return jsonify({'error': f'chunk {idx} has {received} bytes, expected {expected}'}), 400
+        if chunk_md5 and h.hexdigest() != chunk_md5.lower():
+            return jsonify({'error': f'chunk {idx} md5 mismatch', 'chunkIndex': idx}), 400
+    else:
+        # ---- 旧模式：每片单独存为 <n>.part，merge 时拼接 ----
+        part_path = os.path.join(tmp_dir, f'{idx:05d}.part')
+        tmp_path  = _tmp_name(part_path)
+        try:
+            with open(tmp_path, 'wb') as f:
+                for blk in _iter_stream(stream):
+                    h.update(blk)
+                    f.write(blk)
+                    received += len(blk)
+            if chunk_md5 and h.hexdigest() != chunk_md5.lower():
+                os.remove(tmp_path)
+                return jsonify({'error': f'chunk {idx} md5 mismatch', 'chunkIndex': idx}), 400
+            # 新数据完整且校验通过后才替换旧分片，替换前撤掉旧分片的摘要记录
+            _invalidate_chunk(tmp_dir, idx)
+            os.replace(tmp_path, part_path)
+        except Exception:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    elapsed = time.perf_counter() - start
+    mbps = received / 2**20 / elapsed if elapsed > 0 else None
+    print(f"chunk {idx}: {received / 2**20:.1f} MB in {elapsed:.3f}s"
+          + (f" ({mbps:.1f} MB/s, {'raw' if raw else 'multipart'})" if mbps else ""))
+
+    # 数据落盘后才写本片的摘要记录：有记录 = 该片完整可用
+    _write_text_atomic(os.path.join(tmp_dir, f'{idx:05d}.md5'), f'{h.hexdigest()} {received}')
+    _schedule_md5(tmp_dir)
 
     if md5_end:
-        with open(os.path.join(tmp_dir, '_md5.txt'), 'w') as f:
-            f.write(md5_end)
+        _write_text_atomic(os.path.join(tmp_dir, '_md5.txt'), md5_end)
+    _write_text_atomic(os.path.join(tmp_dir, '_history.txt'), history_id)
+
+    return jsonify({'message': f'chunk {idx} ok', 'chunkIndex': idx, 'chunkMd5': h.hexdigest(),
+                    'bytes': received, 'MBps': round(mbps, 2) if mbps else None}), 200
 
-    with open(os.path.join(tmp_dir, '_history.txt'), 'w') as f:
-        f.write(history_id)
 
-    return jsonify({'message': f'chunk {idx} ok'}), 200
+# ================== 2b. upload-status ==================
+# 断点续传：前端先查询已收到的分片，只补传缺失的部分
+@auth_bp.route('/upload-status', methods=['GET'])
+@jwt_required()
+def upload_status():
+    history_id = request.args.get('historyId')
+    file_id    = request.args.get('fileId')
+    folder_tp  = request.args.get('folderType')
+    tmp_dir = _chunk_dir(get_jwt_identity(), history_id, folder_tp, file_id)
+    if tmp_dir is None:
+        return jsonify({'error': 'invalid params'}), 400
+
+    chunks = _received_chunks(tmp_dir)
+    received_bytes = sum(size for _, size in chunks.values())
+    throughput = None
+    started_path = os.path.join(tmp_dir, '_started')
+    if chunks and os.path.exists(started_path):
+        started = os.path.getmtime(started_path)
+        last = max(os.path.getmtime(os.path.join(tmp_dir, f'{i:05d}.md5')) for i in chunks)
+        if last > started:
+            throughput = received_bytes / (last - started) / 2**20
+
+    return jsonify({
+        'historyId': history_id,
+        'fileId': file_id,
+        'folderType': folder_tp,
+        'received': sorted(chunks),
+        'receivedBytes': received_bytes,
+        'throughputMBps': round(throughput, 2) if throughput is not None else None,
+    }), 200
 
 
 # ================== 3. merge-chunks ==================
@@ -415,28 +682,67 @@ def merge_chunks():
     if not all([history_id,file_id,file_name,folder_tp,md5_front]):
         return jsonify({'error':'missing params'}), 400
 
-    uid  = get_jwt_identity()
-    base_user = mongo.db.users.find_one({'_id':ObjectId(uid)})['username']
-    base = os.path.join(current_app.config['UPLOAD_ROOT'], base_user)
-    tmp_dir = os.path.join(base, history_id, f'tmp_{folder_tp}', file_id)
+    tmp_dir = _chunk_dir(get_jwt_identity(), history_id, folder_tp, file_id)
+    if tmp_dir is None or os.path.basename(file_name) != file_name:
+        return jsonify({'error':'invalid params'}), 400
+    base = os.path.dirname(os.path.dirname(os.path.dirname(tmp_dir)))
     if not os.path.isdir(tmp_dir):
         return jsonify({'error':'tmp dir not found'}), 400
-    with open(os.path.join(tmp_dir,'_md5.txt')) as f: md5_saved = f.read().strip()
+    md5_path = os.path.join(tmp_dir,'_md5.txt')
+    md5_saved = md5_front
+    if os.path.exists(md5_path):
+        with open(md5_path) as f:
+            md5_saved = f.read().strip()
+
+    # ---------- 校验：分片齐全 + 按分片摘要拼出的 manifest + 运行中的整文件 md5 ----------
+    chunks = _received_chunks(tmp_dir)
+    layout = _read_layout(tmp_dir)
+    if layout:
+        num_chunks = -(-layout['file_size'] // layout['chunk_size'])
+    else:
+        num_chunks = max(chunks, default=-1) + 1
+    missing = [i for i in range(num_chunks) if i not in chunks]
+    if not chunks or missing:
+        return jsonify({'error':'missing chunks','missing':missing[:100]}), 400
+
+    state, hashed = _advance_md5(tmp_dir)       # 等后台线程算完，补上它还没算到的分片；进程重启过时这里会从头补算
+    if hashed != num_chunks:
+        return jsonify({'error':'missing chunks','missing':[hashed]}), 400
+    md5_calc = state['md5'].hexdigest()
+    if md5_calc!=md5_saved or md5_saved!=md5_front:
+        with _running_md5_lock:
+            _running_md5.pop(tmp_dir, None)          # 重传分片后再次 merge 时从磁盘重新计算
+        return jsonify({'error':'md5 mismatch'}),400
+
+    manifest = {
+        'fileName': file_name,
+        'size': sum(size for _, size in chunks.values()),
+        'chunkSize': layout['chunk_size'] if layout else None,
+        'md5': md5_calc,
+        'chunks': [{'index': i, 'md5': chunks[i][0], 'size': chunks[i][1]} for i in range(num_chunks)],
+    }
 
+    # ---------- 落到目标位置 ----------
     dest_dir = os.path.join(base, history_id, folder_tp)
     _ensure(dest_dir)
     dest_path = os.path.join(dest_dir, file_name)
-    with open(dest_path,'wb') as out_f:
-        for p in sorted(glob.glob(os.path.join(tmp_dir,'*.part'))):
-            with open(p,'rb') as in_f: shutil.copyfileobj(in_f,out_f,8*1024*1024)
-    h = hashlib.md5()
-    with open(dest_path, 'rb') as fp:
-        for blk in iter(lambda: fp.read(8*1024*1024), b''):
-            h.update(blk)
-    md5_calc = h.hexdigest()
-
-    if md5_calc!=md5_saved or md5_saved!=md5_front:
-        os.remove(dest_path); return jsonify({'error':'md5 mismatch'}),400
+    if layout:
+        os.replace(os.path.join(tmp_dir, '_data'), dest_path)        # 已经是完整文件，只需改名
+    else:
+        tmp_dest = _tmp_name(dest_path)
+        fd = os.open(tmp_dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for i in range(num_chunks):
+                _copy_into(os.path.join(tmp_dir, f'{i:05d}.part'), fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_dest, dest_path)
+
+    manifest_dir = os.path.join(base, history_id, 'manifests', folder_tp)
+    _ensure(manifest_dir)
+    _write_text_atomic(os.path.join(manifest_dir, f'{file_name}.json'), json.dumps(manifest))
+    with _running_md5_lock:
+        _running_md5.pop(tmp_dir, None)
 
     shutil.rmtree(tmp_dir,ignore_errors=True)
     parent_tmp = os.path.dirname(tmp_dir)
@@ -507,6 +813,7 @@ def run_preprocess():
     if not os.path.exists(metadata_lr) or not os.path.exists(metadata_hr):
         return jsonify({'error': 'Missing scan_settings.txt'}), 400
 
+    _h5_release(history_dir)
     try:
         result = run_registration(
             slices_path_full=lr_dir,
@@ -685,6 +992,29 @@ def preprocess_preview():
 
 
 
+# ================== h5 preview cache ==================
+# Process-wide caches shared by all preview requests: open file handles (bounded by count,
+# closed on eviction) and rendered PNG slices (bounded by bytes), keyed by path and mtime
+# so a rewritten volume never serves stale slices.
+H5_MAX_OPEN_FILES   = 8
+H5_SLICE_CACHE_SIZE = 256 * 1024 * 1024           # 256 MB of encoded PNGs
+
+_h5_lock       = threading.Lock()                 # h5py serialises calls anyway; also guards handle eviction
+_h5_files      = LRUCache(max_items=H5_MAX_OPEN_FILES, on_evict=lambda key, f: f.close())
+_h5_slice_pngs = LRUCache(max_bytes=H5_SLICE_CACHE_SIZE)
+
+def _h5_dataset(path, mtime):
+    """Return the 'data' dataset of an h5 volume from the handle cache. Call with _h5_lock held."""
+    f = _h5_files.get_or_create((path, mtime), lambda: h5py.File(path, 'r'))
+    return f['data']
+
+def _h5_release(directory):
+    """Close cached handles under `directory` before the volumes there are rewritten in-process."""
+    directory = os.path.join(os.path.abspath(directory), '')
+    with _h5_lock:
+        for key in [k for k in _h5_files.keys() if os.path.abspath(k[0]).startswith(directory)]:
+            _h5_files.pop(key)
+
 @auth_bp.route('/h5-slice', methods=['GET'])
 @jwt_required()
 def h5_slice():
@@ -729,20 +1059,17 @@ def h5_slice():
         return jsonify({'error': f'H5 file not found: {h5_abs_path}'}), 404
 
     try:
-        with h5py.File(h5_abs_path, 'r') as f:
-            vol = f['data'][:]
-            if axis == 'x':
-                if index >= vol.shape[0]:
-                    return jsonify({'error': 'Index out of range'}), 400
-                slice_data = vol[index, :, :]
-            elif axis == 'y':
-                if index >= vol.shape[1]:
-                    return jsonify({'error': 'Index out of range'}), 400
-                slice_data = vol[:, index, :]
-            else:  # 'z'
-                if index >= vol.shape[2]:
+        mtime = os.stat(h5_abs_path).st_mtime_ns
+        png_key = (h5_abs_path, mtime, axis, index)
+        png = _h5_slice_pngs.get(png_key)
+        if png is None:
+            with _h5_lock:
+                dataset = _h5_dataset(h5_abs_path, mtime)
+                dim = {'x': 0, 'y': 1, 'z': 2}[axis]
+                if index >= dataset.shape[dim]:
                     return jsonify({'error': 'Index out of range'}), 400
-                slice_data = vol[:, :, index]
+                # hyperslab read: only the requested plane is read from disk
+                slice_data = dataset[(slice(None),) * dim + (index,)]
 
             norm = (slice_data - np.min(slice_data)) / (np.ptp(slice_data) + 1e-8)
             image_uint8 = (norm * 255).astype(np.uint8)
@@ -750,8 +1077,9 @@ def h5_slice():
 
             buffer = io.BytesIO()
             img.save(buffer, format='PNG')
-            buffer.seek(0)
-            return send_file(buffer, mimetype='image/png')
+            png = _h5_slice_pngs.put(png_key, buffer.getvalue())
+
+        return send_file(io.BytesIO(png), mimetype='image/png')
 
     except Exception as e:
         return jsonify({'error': f'Failed to load H5 file: {str(e)}'}), 500
@@ -772,8 +1100,8 @@ def h5_meta():
         return jsonify({'error': f'File not found: {h5_path}'}), 404
 
     try:
-        with h5py.File(h5_path, 'r') as f:
-            shape = list(f['data'].shape)
+        with _h5_lock:
+            shape = list(_h5_dataset(h5_path, os.stat(h5_path).st_mtime_ns).shape)
         return jsonify({'shape': shape}), 200
     except Exception as e:
         return jsonify({'error': f'Failed to read h5: {str(e)}'}), 500
@@ -823,7 +1151,22 @@ def get_train_options():
 # 全局变量：记录所有训练任务的进程
 train_processes = {}
 
+# 每个训练进程分配互不重叠的 CPU 核（线程数 / 亲和性 / 可选 NUMA 内存绑定），避免多任务并发时互相抢核
+TRAIN_MAX_JOBS = int(os.environ.get('TRAIN_MAX_JOBS', 2))          # 预计同时运行的训练任务数
+TRAIN_CORES_PER_JOB = int(os.environ.get('TRAIN_CORES_PER_JOB', 0)) or None
+TRAIN_BIND_NUMA = os.environ.get('TRAIN_BIND_NUMA', '0') == '1'
+
+cpu_placement = CpuPlacementPolicy(max_jobs=TRAIN_MAX_JOBS, cores_per_job=TRAIN_CORES_PER_JOB, bind_numa=TRAIN_BIND_NUMA)
+
 def run_training_wrapper(opt, directories, stage):
+    # 在子进程里任何 torch 计算之前先固定核与线程数（线程池是第一次计算时才创建的）
+    if getattr(opt, 'placement', None):
+        CpuPlacement.from_dict(opt.placement).apply()
+    # 精度 / 内存布局策略与每个 epoch 的计时，训练脚本用 opt.precision_policy（autocast、scaler、
+    # prepare_model / prepare_input）和 opt.epoch_timer（start / stop）
+    opt.precision_policy = prepare_precision(prepare_device(opt.use_cuda, opt.gpu_index),
+                                             getattr(opt, 'precision', 'fp32'), getattr(opt, 'channels_last', False))
+    opt.epoch_timer = EpochTimer(label=str(opt.precision_policy))
     if stage == "stage1":
         train_stage1_func(opt, directories)
     elif stage == "stage2":
@@ -833,6 +1176,54 @@ def run_training_wrapper(opt, directories, stage):
 class Opt:
     pass
 
+def start_training_process(opt, directories, stage, user_id, history_id, base_dir):
+    """分配 CPU 核、写入 metadata.json 后启动训练进程"""
+    key = (str(user_id), history_id)
+    placement = cpu_placement.acquire(key)
+    opt.placement = placement.to_dict()
+
+    meta_path = os.path.join(base_dir, 'metadata.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta.setdefault('placement', {})[stage] = opt.placement
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    process = Process(target=run_training_wrapper, args=(opt, directories, stage))
+    cpu_placement.track(key, process)
+    try:
+        process.start()
+    except Exception:
+        cpu_placement.release(key)
+        raise
+    train_processes[key] = process
+    return process
+
+def parse_precision_options(data):
+    """读取每个任务的精度 / 内存布局设置（见 utils.PrecisionPolicy），非法时抛 ValueError"""
+    precision = data.get('precision', 'fp32')             # fp32 | bf16 | fp16 | auto
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision, expected one of {PRECISIONS}")
+    channels_last = bool(data.get('channels_last', False))
+    return precision, channels_last
+
+def parse_checkpointing_options(data):
+    """读取生成器激活重计算设置（见 GeneratorSR.set_activation_checkpointing），非法时抛 ValueError"""
+    enabled = bool(data.get('gen_activation_checkpointing', False))
+    segments = data.get('gen_checkpoint_segments')        # None = 每个 ResBlock 一段
+    if segments is not None:
+        error = ValueError("gen_checkpoint_segments must be a positive integer or null")
+        if isinstance(segments, bool) or (isinstance(segments, float) and not segments.is_integer()):
+            raise error
+        try:
+            segments = int(segments)
+        except (TypeError, ValueError):
+            raise error
+        if segments < 1:
+            raise error
+    return enabled, segments
+
 
 @auth_bp.route('/train-stage', methods=['POST'])
 @jwt_required()
@@ -852,6 +1243,18 @@ def run_train_stage():
 
         if not history_id or not re.match(r'^history_\d+$', history_id):
             return jsonify({'error': 'Invalid history_id'}), 400
+        try:
+            precision, channels_last = parse_precision_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        gen_upsampler = data.get('gen_upsampler', 'nearest')   # nearest | pixelshuffle（保存在 checkpoint 里，续训 / 推理时从中读取）
+        if gen_upsampler not in GeneratorSR.UPSAMPLERS:
+            return jsonify({'error': f'Invalid gen_upsampler, expected one of {GeneratorSR.UPSAMPLERS}'}), 400
+        # 生成器激活重计算（GeneratorSR.set_activation_checkpointing）：以重计算换内存，按 stage 单独开启
+        try:
+            gen_activation_checkpointing, gen_checkpoint_segments = parse_checkpointing_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         base_dir = os.path.join(current_app.config['UPLOAD_ROOT'], username, history_id)
 
@@ -962,11 +1365,18 @@ def run_train_stage():
             for d in directories.values():
                 os.makedirs(d, exist_ok=True)
 
+            opt.precision = precision
+            opt.channels_last = channels_last
+            opt.gen_upsampler = gen_upsampler
+            opt.gen_activation_checkpointing = gen_activation_checkpointing
+            opt.gen_checkpoint_segments = gen_checkpoint_segments
+
+            # 重新训练会改写 checkpoint，释放该 history 已常驻的模型
+            model_registry.invalidate(user['_id'], history_id, stage)
+
             # ******** debug 3 ************ 改成opt 而不是 Opt(), 对象已实例化
             # process = Process(target=run_training_wrapper, args=(Opt(), directories, stage))
-            process = Process(target=run_training_wrapper, args=(opt, directories, stage))
-            process.start()
-            train_processes[(str(user['_id']), history_id)] = process
+            start_training_process(opt, directories, stage, user['_id'], history_id, base_dir)
 
             return jsonify({'message': f'{stage} training started'}), 200
 
@@ -980,6 +1390,20 @@ def run_train_stage():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+# ================== model registry ==================
+# Ready-to-run generators kept warm across /api/inference calls, bounded by their memory
+# footprint; keyed by checkpoint mtime so retrained checkpoints are never served stale.
+MODEL_REGISTRY_SIZE = int(os.environ.get('MODEL_REGISTRY_SIZE', 2 * 1024 ** 3))   # 2 GB of weights
+
+model_registry = ModelRegistry(max_bytes=MODEL_REGISTRY_SIZE)
+
+# 各阶段推理所用生成器在训练 checkpoint 中的条目名（Stage1 存上 / 下采样两个 GeneratorSR，
+# Stage2 存两个同结构的 ResnetGenerator，按结构无法区分）；请求里的 checkpoint_key 可覆盖
+INFERENCE_CHECKPOINT_KEYS = {
+    "stage1": os.environ.get('STAGE1_INFERENCE_KEY', 'netG_lr2hr'),
+    "stage2": os.environ.get('STAGE2_INFERENCE_KEY', 'netG_yz2xz'),
+}
+
 # ------------------------- Inference API ------------------------- #
 @auth_bp.route("/inference", methods=["POST"])
 @jwt_required()
@@ -997,15 +1421,40 @@ def run_inference():
         stage = data.get("stage", "stage1").lower()
         history_id = data.get("history_id")
         checkpoint_epoch = data.get("checkpoint_epoch")        # int | None
+        backend = data.get("backend", "torch")                 # torch | onnxruntime
+        quantization = data.get("quantization")                # None | dynamic | static
+        checkpoint_key = data.get("checkpoint_key")            # checkpoint 中生成器的条目名，默认见 INFERENCE_CHECKPOINT_KEYS
         print(stage)
         print(history_id)
         print(checkpoint_epoch)
 
         if not history_id or not re.match(r"^history_\d+$", history_id):
             return jsonify({"error": "Invalid history_id"}), 400
+        if backend not in INFERENCE_BACKENDS:
+            return jsonify({"error": f"Invalid backend, expected one of {INFERENCE_BACKENDS}"}), 400
+        if quantization is not None and quantization not in QUANTIZATION_MODES:
+            return jsonify({"error": f"Invalid quantization, expected one of {QUANTIZATION_MODES}"}), 400
+        if quantization is not None and backend != "torch":
+            return jsonify({"error": "quantization needs the torch backend"}), 400
+        if checkpoint_key is None:
+            checkpoint_key = INFERENCE_CHECKPOINT_KEYS.get(stage)
+        elif not isinstance(checkpoint_key, str):
+            return jsonify({"error": "checkpoint_key must be a string"}), 400
+        try:
+            intra_op_threads = int(data.get("intra_op_threads", 0))   # 0 = 运行时默认
+            inter_op_threads = int(data.get("inter_op_threads", 0))
+        except (TypeError, ValueError):
+            return jsonify({"error": "intra_op_threads / inter_op_threads must be integers"}), 400
+        if backend == "torch" and (intra_op_threads or inter_op_threads):
+            # torch 的线程池是进程级的，在 Flask 进程里设置会影响所有请求
+            return jsonify({"error": "intra_op_threads / inter_op_threads only apply to the onnxruntime backend"}), 400
+        try:
+            precision, channels_last = parse_precision_options(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         base_dir = os.path.join(current_app.config["UPLOAD_ROOT"], username, history_id)
-        
+        _h5_release(base_dir)
 
         # ---------- 1. Stage-1 ----------
         if stage == "stage1":
@@ -1055,6 +1504,30 @@ def run_inference():
             opt.inference_checkpoint_epoch = target_epoch         # ← 改好了
             opt.inference_plane = None                            # yz / xz 时再覆盖
 
+            # 分块推理（inference.tiled_inference）：峰值内存只取决于 tile 与 batch，与平面大小无关
+            opt.inference_tile_size  = 128                        # LR 像素
+            opt.inference_tile_halo  = 16                         # 相邻 tile 各共享的上下文像素
+            opt.inference_batch_size = "auto"                     # 按内存预算探测（inference.find_max_batch_size）
+            opt.inference_memory_fraction = 0.5                   # 可用内存中留给推理的比例
+            opt.inference_window     = "linear"
+
+            # 推理后端（onnx_backend.load_backend）：onnxruntime 时导出的 .onnx 缓存在 .pt 旁边
+            opt.inference_backend          = backend
+            opt.inference_intra_op_threads = intra_op_threads
+            opt.inference_inter_op_threads = inter_op_threads
+            opt.inference_checkpoint_key   = checkpoint_key
+
+            # 精度 / 内存布局（utils.prepare_precision）
+            opt.precision     = precision
+            opt.channels_last = channels_last
+
+            # int8 量化（quantization.quantize_generator）：一半训练输入 crop 用来校准，另一半上报告 int8 相对 fp32 输出的 PSNR/SSIM
+            opt.inference_quantization    = quantization
+            opt.quantization_crop_dir     = os.path.join(base_dir, "Train", "Stage1", "lr")   # 生成器的输入 crop
+            opt.quantization_report_path  = os.path.join(
+                base_dir, "Inference", "Stage1", f"quantization_{quantization}.json"
+            )
+
             # 是否需要重新裁切生成训练/测试数据集
             opt.create_training_testing_dataset = True
             opt.test_ratio = 0.10
@@ -1088,6 +1561,24 @@ def run_inference():
             assert os.path.exists(opt.inference_image_full_path), "LR 体数据不存在！"
             assert os.path.exists(opt.inference_checkpoint_path), "指定 checkpoint 不存在！"
 
+            # 常驻模型：同一 checkpoint + 同一推理配置的重复请求直接复用已加载的生成器
+            opt.model_registry = model_registry
+            opt.model_registry_key = ModelRegistry.make_key(
+                user_id, history_id, stage, opt.inference_checkpoint_epoch, opt.inference_checkpoint_path,
+                variant=(backend, quantization, precision, channels_last, intra_op_threads, inter_op_threads,
+                         checkpoint_key),
+            )
+            # 按上面的后端 / 量化 / 精度 / 分块设置的生成器，stage 直接用 opt.generator 推理（首次调用时才加载）
+            # GeneratorSR 只看输入输出尺寸之比，即 data.adjust_lr_voxel_size 取整后的体素比；
+            # 上采样方式按训练时的设置，从 checkpoint 中读取
+            sf = round(opt.voxel_size_lr / opt.voxel_size_hr)
+            opt.generator = load_inference_generator(opt, lambda: GeneratorSR(
+                (opt.lr_image_channels, opt.crop_size, opt.crop_size),
+                (opt.hr_image_channels, opt.crop_size * sf, opt.crop_size * sf),
+                baseFilters=opt.gen_baseFilters, numResBlocks=opt.gen_numResBlocks,
+                upsampler=GeneratorSR.checkpoint_upsampler(checkpoint_entry(opt.inference_checkpoint_path, checkpoint_key)),
+            ))
+
             # --------- yz 平面 ---------
             opt.inference_plane = "yz"
             inference_stage1(opt, directories)
@@ -1135,6 +1626,30 @@ def run_inference():
             opt.inference_checkpoint_epoch = checkpoint_epoch or default_opt["n_epochs"]
             opt.test_rate                  = 1000
 
+            # --- 分块推理（inference.tiled_inference） ---
+            opt.inference_tile_size  = 192
+            opt.inference_tile_halo  = 16
+            opt.inference_batch_size = "auto"
+            opt.inference_memory_fraction = 0.5
+            opt.inference_window     = "linear"
+
+            # --- 推理后端（onnx_backend.load_backend） ---
+            opt.inference_backend          = backend
+            opt.inference_intra_op_threads = intra_op_threads
+            opt.inference_inter_op_threads = inter_op_threads
+            opt.inference_checkpoint_key   = checkpoint_key
+
+            # --- 精度 / 内存布局（utils.prepare_precision） ---
+            opt.precision     = precision
+            opt.channels_last = channels_last
+
+            # --- int8 量化（quantization.quantize_generator） ---
+            opt.inference_quantization    = quantization
+            opt.quantization_crop_dir     = os.path.join(base_dir, "Train", "Stage2", "yz")   # 生成器的输入 crop（yz 与 xz 不成对）
+            opt.quantization_report_path  = os.path.join(
+                base_dir, "Inference", "Stage2", f"quantization_{quantization}.json"
+            )
+
             directories = {
                 "checkpoints_dir": os.path.join(base_dir, "checkpoints", "Stage2"),
                 "inference_out_dir": os.path.join(base_dir, "Inference", "Stage2"),
@@ -1148,6 +1663,17 @@ def run_inference():
             for p in (opt.path_image_yz, opt.path_image_xz, opt.inference_checkpoint_path):
                 assert os.path.exists(p), f"lack: {p}"
 
+            # 常驻模型（见 model_registry）
+            opt.model_registry = model_registry
+            opt.model_registry_key = ModelRegistry.make_key(
+                user_id, history_id, stage, opt.inference_checkpoint_epoch, opt.inference_checkpoint_path,
+                variant=(backend, quantization, precision, channels_last, intra_op_threads, inter_op_threads,
+                         checkpoint_key),
+            )
+            opt.generator = load_inference_generator(opt, lambda: ResnetGenerator(
+                opt.gen_in_channels, 1, ngf=opt.gen_baseFilters, n_blocks=opt.gen_numResBlocks,
+            ))
+
             # 执行推理
             inference_stage2(opt, directories)
 
@@ -1160,6 +1686,10 @@ def run_inference():
     except AssertionError as e:
         # 自定义断言错误 → 400
         return jsonify({"error": str(e)}), 400
+    except ValueError as e:
+        # checkpoint 里找不到 / 无法确定生成器条目（见 checkpoints.generator_state_dict）→ 400
+        current_app.logger.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         # 记录完整回溯，返回 500
         current_app.logger.error(traceback.format_exc())
@@ -1197,6 +1727,7 @@ def stop_training():
             process.terminate()  # 强制终止
 
         del train_processes[key]
+        cpu_placement.release(key)
         return jsonify({'message': f'Training process for {history_id} has been stopped'}), 200
 
     except Exception as e:
@@ -1219,6 +1750,14 @@ def resume_training():
 
     if not history_id or not re.match(r'^history_\d+$', history_id):
         return jsonify({'error': 'Invalid history_id'}), 400
+    try:
+        precision, channels_last = parse_precision_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        gen_activation_checkpointing, gen_checkpoint_segments = parse_checkpointing_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     base_dir = os.path.join(current_app.config['UPLOAD_ROOT'], username, history_id)
 
@@ -1279,6 +1818,10 @@ def resume_training():
             opt.gen_baseFilters = 64
             opt.disc_baseFilters = 64
             opt.resume_checkpoint_epoch = latest_epoch
+            # 上采样方式沿用 checkpoint 里保存的（两个 GeneratorSR 相同）
+            opt.gen_upsampler = GeneratorSR.checkpoint_upsampler(
+                checkpoint_entry(os.path.join(checkpoints_dir, f"{latest_epoch}.pt"))
+            )
 
 
             directories = {
@@ -1327,15 +1870,19 @@ def resume_training():
                 "inference_out_dir": os.path.join(base_dir, "Inference", "Stage2"),
             }
 
-        
+        opt.precision = precision
+        opt.channels_last = channels_last
+        opt.gen_activation_checkpointing = gen_activation_checkpointing
+        opt.gen_checkpoint_segments = gen_checkpoint_segments
+
+        model_registry.invalidate(user['_id'], history_id, stage)
+
         for d in directories.values():
             os.makedirs(d, exist_ok=True)
 
         # ********** debug 5 ********** 所有的 process初始化，arg 的 opt要改
         # 应该也就是一个train 一个inference了
-        process = Process(target=run_training_wrapper, args=(opt, directories, stage))
-        process.start()
-        train_processes[(str(user['_id']), history_id)] = process
+        start_training_process(opt, directories, stage, user['_id'], history_id, base_dir)
 
         return jsonify({'message': f'{stage} resume training from checkpoint {latest_epoch} started'}), 200
 
@@ -1485,10 +2032,10 @@ def list_checkpoints():
         print("Not the checkpoint path")
         return jsonify({'checkpoints': []}), 200
 
-    # 获取所有 .pt 文件名
+    # 获取所有 <epoch>.pt 文件名（跳过 <epoch>[.<key>].gen.pt 精简权重）
     checkpoint_files = sorted([
         f for f in os.listdir(checkpoint_dir)
-        if os.path.isfile(os.path.join(checkpoint_dir, f)) and f.endswith('.pt')
+        if os.path.isfile(os.path.join(checkpoint_dir, f)) and f.endswith('.pt') and f[:-3].isdigit()
     ])
     print("ck files",checkpoint_files)
 
@@ -0,0 +1,259 @@
+import torch
+import numpy as np
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from torch.utils.flop_counter import FlopCounterMode
+
+from data import AxisViews, single_random_crop, batch_random_crop, _plane_crop
+from models import GeneratorSR, ResnetGenerator, fuse_for_inference
+from utils import ReplayBuffer
+#%%
+# Micro-benchmarks for the data and model code paths. Run from the backend folder, e.g.
+#   python benchmarks.py axis_crops --size 256 --crop 64 64
+
+def _timeit(fn, repeat=5, warmup=1):
+    """Best and mean wall time in seconds of `repeat` calls of fn() after `warmup` calls."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+def _report(name, best, mean, count=1):
+    print(f"{name:<40s} best {best * 1e3:9.3f} ms  mean {mean * 1e3:9.3f} ms  ({best / count * 1e6:8.2f} us/item)")
+
+def bench_axis_crops(args):
+    """Per-axis cost of 2D crops on a C-ordered volume, in memory and on disk, with and without AxisViews."""
+    rng = np.random.default_rng(0)
+    size, scale = args.size, args.scale
+    crop_size_lr = tuple(args.crop)
+    image_lr = rng.integers(0, 256, (size, size, size), dtype=np.uint8)
+    image_hr = rng.integers(0, 256, (size * scale,) * 3, dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for name, image in (("lr.npy", image_lr), ("hr.npy", image_hr)):
+            np.save(os.path.join(tmp_dir, name), image)
+            paths.append(os.path.join(tmp_dir, name))
+        lazy = [np.load(path, mmap_mode="r") for path in paths]
+
+        sources = {
+            "ndarray": (image_lr, image_hr),
+            "ndarray+AxisViews": (AxisViews(image_lr), AxisViews(image_hr)),
+            "memmap": tuple(lazy),
+            "memmap+AxisViews": tuple(AxisViews(volume, cache_dir=tmp_dir) for volume in lazy),
+        }
+        for name, (lr, hr) in sources.items():
+            if isinstance(lr, AxisViews):
+                start = time.perf_counter()
+                for volume in (lr, hr):
+                    volume.axis_first('h')
+                    volume.axis_first('w')
+                print(f"{name}: built axis-first copies in {time.perf_counter() - start:.3f} s")
+
+            for axis, axis_id in (('d', 0), ('h', 1), ('w', 2)):
+                # Fix the sampling axis by drawing all origins for it up front.
+                index = rng.integers(0, size - max(crop_size_lr) + 1, (args.num_crops, 3))
+                def run():
+                    for d, h, w in index:
+                        if axis_id == 0:
+                            lr_crop = _plane(lr, 'd', d, h, w, crop_size_lr)
+                            hr_crop = _plane(hr, 'd', d * scale, h * scale, w * scale, [c * scale for c in crop_size_lr])
+                        elif axis_id == 1:
+                            lr_crop = _plane(lr, 'h', h, d, w, crop_size_lr)
+                            hr_crop = _plane(hr, 'h', h * scale, d * scale, w * scale, [c * scale for c in crop_size_lr])
+                        else:
+                            lr_crop = _plane(lr, 'w', w, d, h, crop_size_lr)
+                            hr_crop = _plane(hr, 'w', w * scale, d * scale, h * scale, [c * scale for c in crop_size_lr])
+                        np.ascontiguousarray(lr_crop), np.ascontiguousarray(hr_crop)
+                best, mean = _timeit(run, repeat=args.repeat)
+                _report(f"{name} axis '{axis}'", best, mean, args.num_crops)
+
+            best, mean = _timeit(lambda: batch_random_crop(lr, hr, scale, crop_size_lr, args.num_crops), repeat=args.repeat)
+            _report(f"{name} batch_random_crop", best, mean, args.num_crops)
+            best, mean = _timeit(lambda: [single_random_crop(lr, hr, scale, crop_size_lr) for _ in range(args.num_crops)], repeat=args.repeat)
+            _report(f"{name} single_random_crop", best, mean, args.num_crops)
+
+def _plane(volume, axis, index, row, col, crop_size):
+    """Crop of plane `index` along `axis`, rows/cols starting at (row, col) in (d, h, w) order."""
+    return _plane_crop(volume, axis, index, slice(row, row + crop_size[0]), slice(col, col + crop_size[1]))
+
+def _randomize_batchnorm(model):
+    """Give every BatchNorm non-trivial running statistics and affine parameters, as after training."""
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+def bench_fuse_conv_bn(args):
+    """Check that fuse_for_inference preserves the outputs and time the fused vs unfused generators."""
+    torch.manual_seed(0)
+    size, scale = args.size, args.scale
+    models = {
+        "GeneratorSR": GeneratorSR(inShape=(1, size, size), outShape=(1, size * scale, size * scale), numResBlocks=6),
+        "ResnetGenerator": ResnetGenerator(input_nc=1, output_nc=1, ngf=64, n_blocks=5),
+    }
+    x = torch.randn(args.batch_size, 1, size, size)
+    for name, model in models.items():
+        model = _randomize_batchnorm(model)
+        fused = fuse_for_inference(model)
+        reference, output = model(x), fused(x)
+        error = (reference - output).abs().max().item()
+        assert torch.allclose(reference, output, rtol=1e-4, atol=1e-5 * reference.abs().max().item()), \
+            f"{name}: fused output differs by {error}"
+        print(f"{name}: max abs difference {error:.3e} (output max {reference.abs().max().item():.3e})")
+
+        best, mean = _timeit(lambda: model(x), repeat=args.repeat)
+        _report(f"{name} unfused", best, mean, args.batch_size)
+        best_fused, mean_fused = _timeit(lambda: fused(x), repeat=args.repeat)
+        _report(f"{name} fused", best_fused, mean_fused, args.batch_size)
+        print(f"{name}: speedup x{best / best_fused:.2f}")
+
+def _count_flops(model, x):
+    with FlopCounterMode(display=False) as counter:
+        model(x)
+    return counter.get_total_flops()
+
+def bench_upsampler(args):
+    """FLOPs and latency of GeneratorSR with the nearest and pixelshuffle upsamplers, per scale factor."""
+    torch.manual_seed(0)
+    size = args.size
+    x = torch.randn(args.batch_size, 1, size, size)
+    for sf in args.scales:
+        results = {}
+        for upsampler in GeneratorSR.UPSAMPLERS:
+            model = GeneratorSR(inShape=(1, size, size), outShape=(1, size * sf, size * sf),
+                                numResBlocks=6, upsampler=upsampler).eval()
+            params = sum(p.numel() for p in model.parameters())
+            flops = _count_flops(model, x) / args.batch_size
+            best, mean = _timeit(lambda: model(x), repeat=args.repeat)
+            results[upsampler] = (flops, best)
+            print(f"x{sf} {upsampler:<12s} {params / 1e6:6.3f} M params  {flops / 1e9:8.2f} GFLOP/sample")
+            _report(f"x{sf} {upsampler}", best, mean, args.batch_size)
+        print(f"x{sf}: pixelshuffle uses {results['pixelshuffle'][0] / results['nearest'][0]:.2f}x the FLOPs, "
+              f"speedup x{results['nearest'][1] / results['pixelshuffle'][1]:.2f}")
+
+def _saved_tensor_bytes(step):
+    """Bytes of the tensors autograd keeps for the backward pass of step(), and step()'s result."""
+    saved = []
+    def pack(tensor):
+        saved.append(tensor.untyped_storage().nbytes() if tensor.layout == torch.strided else 0)
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = step()
+    return sum(saved), result
+
+def bench_activation_checkpointing(args):
+    """Activation memory and training-step time of GeneratorSR with and without checkpointing, per crop size."""
+    torch.manual_seed(0)
+    torch.set_grad_enabled(True)
+    for crop in args.crop_sizes:
+        for enabled in (False, True):
+            model = GeneratorSR(inShape=(1, crop, crop), outShape=(1, crop * args.scale, crop * args.scale),
+                                numResBlocks=6).train()
+            model.set_activation_checkpointing(enabled)
+            x = torch.randn(args.batch_size, 1, crop, crop)
+
+            def step():
+                model.zero_grad(set_to_none=True)
+                loss = model(x).square().mean()
+                loss.backward()
+
+            # Checkpointed segments save their activations only while being recomputed in backward,
+            # so the forward pass alone shows what is held between forward and backward.
+            saved, loss = _saved_tensor_bytes(lambda: model(x).square().mean())
+            del loss
+            best, mean = _timeit(step, repeat=args.repeat)
+            label = "checkpointed" if enabled else "baseline"
+            print(f"crop {crop:4d} {label:<12s} activations {saved / 2**20:8.1f} MB  "
+                  f"step best {best * 1e3:8.1f} ms  mean {mean * 1e3:8.1f} ms  "
+                  f"({args.batch_size / best:.1f} samples/s)")
+    torch.set_grad_enabled(False)
+
+class _ListReplayBuffer():
+    """The list-of-tensors ReplayBuffer that utils.ReplayBuffer replaced, as the baseline."""
+    def __init__(self, max_size=50):
+        self.max_size = max_size
+        self.data = []
+
+    def push_and_pop(self, data):
+        to_return = []
+        for element in data.data:
+            element = torch.unsqueeze(element, 0)
+            if len(self.data) < self.max_size:
+                self.data.append(element)
+                to_return.append(element)
+            elif random.uniform(0, 1) > 0.5:
+                i = random.randint(0, self.max_size - 1)
+                to_return.append(self.data[i].clone())
+                self.data[i] = element
+            else:
+                to_return.append(element)
+        return torch.cat(to_return)
+
+def _retained_bytes(buffer):
+    """Bytes of the storages a replay buffer keeps alive; a list entry is a view of its whole batch."""
+    tensors = buffer.data if isinstance(buffer.data, list) else [buffer.data]
+    storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for t in tensors}
+    return sum(storages.values())
+
+def bench_replay_buffer(args):
+    """Per-step cost and retained memory of ReplayBuffer.push_and_pop on a full 50-image pool, list-based vs ring tensor, per batch size."""
+    torch.manual_seed(0)
+    random.seed(0)
+    shape = (1,) + tuple(c * args.scale for c in args.crop)
+    for batch_size in args.batch_sizes:
+        results = {}
+        for name, buffer in (("list", _ListReplayBuffer()), ("ring tensor", ReplayBuffer())):
+            # A fresh batch per step, as the generator produces.
+            batches = [torch.randn(batch_size, *shape) for _ in range(buffer.max_size)]
+            for step in range(-(-buffer.max_size // batch_size) + 100):
+                buffer.push_and_pop(batches[step % len(batches)])
+            best, mean = _timeit(lambda: [buffer.push_and_pop(batches[step % len(batches)]) for step in range(100)],
+                                 repeat=args.repeat)
+            results[name] = best
+            _report(f"batch {batch_size:3d} {name} (per step)", best / 100, mean / 100, batch_size)
+            print(f"batch {batch_size:3d} {name}: {_retained_bytes(buffer) / 2**20:.1f} MB retained")
+        print(f"batch {batch_size}: speedup x{results['list'] / results['ring tensor']:.2f}")
+
+BENCHMARKS = {
+    "axis_crops": bench_axis_crops,
+    "fuse_conv_bn": bench_fuse_conv_bn,
+    "upsampler": bench_upsampler,
+    "activation_checkpointing": bench_activation_checkpointing,
+    "replay_buffer": bench_replay_buffer,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks.")
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--size", type=int, default=256, help="LR volume edge length")
+    parser.add_argument("--scale", type=int, default=2)
+    parser.add_argument("--scales", type=int, nargs="+", default=[2, 4, 10], help="Scale factors compared by 'upsampler'")
+    parser.add_argument("--crop", type=int, nargs="+", default=[64, 64], help="LR crop size")
+    parser.add_argument("--crop-sizes", type=int, nargs="+", default=[64, 96, 128], help="LR crop sizes compared by 'activation_checkpointing'")
+    parser.add_argument("--num-crops", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[4, 8, 16, 32], help="Batch sizes compared by 'replay_buffer'")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    for name in args.benchmarks or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+        print(f"== {name}")
+        BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+    main()
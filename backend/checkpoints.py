@@ -0,0 +1,168 @@
+import torch
+import torch.nn as nn
+
+import os
+import json
+import threading
+
+#%%
+MANIFEST_NAME = "manifest.json"
+SLIM_SUFFIX = ".gen.pt"
+
+_manifest_lock = threading.Lock()
+
+def generator_state_dict(checkpoint, model: nn.Module, key: str = None, checkpoint_path: str = "checkpoint") -> dict:
+    """
+    The state dict of `model` inside a loaded training checkpoint.
+
+    The checkpoint may be a state dict, a whole pickled module, or a dict of several state
+    dicts (e.g. both generators and discriminators); in the last case `key` selects one, or
+    else the single entry whose keys match the model's is used. Checkpoints of two generators
+    with the same architecture (e.g. a cycle's two directions) need `key`; a ValueError naming
+    the candidate entries is raised when it is missing there or names no entry.
+
+    Args:
+        checkpoint: Object returned by torch.load.
+        model (nn.Module): Model with the checkpoint's architecture.
+        key (str, optional): Entry of the checkpoint holding the model's state dict.
+        checkpoint_path (str): Path of the checkpoint, for error messages.
+
+    Returns:
+        dict: State dict loadable into `model`.
+    """
+    if isinstance(checkpoint, nn.Module):
+        checkpoint = checkpoint.state_dict()
+    # Extra state (e.g. GeneratorSR's upsampler flag) is not a tensor and optional in older checkpoints.
+    weights = lambda keys: {k for k in keys if not k.endswith("_extra_state")}
+    if all(isinstance(checkpoint[k], torch.Tensor) for k in weights(checkpoint)):
+        # A single state dict; there is nothing for `key` to select.
+        state_dict = checkpoint
+    elif key is not None:
+        if key not in checkpoint:
+            raise ValueError(f"{checkpoint_path} has no entry {key!r} "
+                             f"(entries: {', '.join(map(str, checkpoint))})")
+        state_dict = checkpoint[key]
+    else:
+        expected = weights(model.state_dict())
+        candidates = [k for k, v in checkpoint.items() if isinstance(v, dict) and weights(v) == expected]
+        assert candidates, f"No state dict matching {type(model).__name__} in {checkpoint_path}"
+        if len(candidates) > 1:
+            raise ValueError(f"{checkpoint_path} holds several {type(model).__name__} state dicts "
+                             f"({', '.join(map(str, candidates))}); pass the key of the one to load")
+        state_dict = checkpoint[candidates[0]]
+    if isinstance(state_dict, nn.Module):
+        state_dict = state_dict.state_dict()
+    return state_dict
+
+def checkpoint_entry(checkpoint_path: str, key: str = None) -> dict:
+    """
+    One state dict of a training checkpoint, without a model to match it against.
+
+    The checkpoint is memory-mapped, so reading e.g. a generator's extra state does not read
+    the discriminators and optimiser states. Returns the entry `key` if the checkpoint has one,
+    the checkpoint itself if it is a single state dict, and otherwise the first entry with
+    extra state (such as GeneratorSR's upsampler mode), or an empty dict.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=False)
+    if isinstance(checkpoint, nn.Module):
+        return checkpoint.state_dict()
+    if all(isinstance(v, torch.Tensor) for k, v in checkpoint.items() if not k.endswith("_extra_state")):
+        return checkpoint
+    entries = {k: v.state_dict() if isinstance(v, nn.Module) else v for k, v in checkpoint.items()
+               if isinstance(v, (dict, nn.Module))}
+    if key in entries:
+        return entries[key]
+    return next((v for v in entries.values() if any(k.endswith("_extra_state") for k in v)), {})
+
+def slim_checkpoint_path(checkpoint_path: str, key: str = None) -> str:
+    """Path of the generator-only copy of a checkpoint: <epoch>[.<key>].gen.pt next to it."""
+    stem = os.path.splitext(checkpoint_path)[0]
+    return f"{stem}.{key}{SLIM_SUFFIX}" if key is not None else stem + SLIM_SUFFIX
+
+def read_manifest(checkpoint_dir: str) -> dict:
+    """Entries of a checkpoint directory's manifest.json, keyed by slim checkpoint file name."""
+    path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _register(checkpoint_dir: str, name: str, entry: dict):
+    path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+    with _manifest_lock:
+        manifest = read_manifest(checkpoint_dir)
+        manifest[name] = entry
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+def _source_stamp(checkpoint_path: str, model: nn.Module, key: str = None) -> dict:
+    stat = os.stat(checkpoint_path)
+    return {"checkpoint": os.path.basename(checkpoint_path),
+            "checkpoint_mtime_ns": stat.st_mtime_ns,
+            "checkpoint_size": stat.st_size,
+            "key": key,
+            "model": type(model).__name__}
+
+def find_slim_checkpoint(checkpoint_path: str, model: nn.Module, key: str = None):
+    """
+    The registered generator-only copy of a checkpoint, or None if there is none or the
+    checkpoint was rewritten since it was exported.
+    """
+    slim_path = slim_checkpoint_path(checkpoint_path, key)
+    name = os.path.basename(slim_path)
+    entry = read_manifest(os.path.dirname(os.path.abspath(checkpoint_path))).get(name)
+    if entry is None or not os.path.exists(slim_path):
+        return None
+    stamp = _source_stamp(checkpoint_path, model, key)
+    if any(entry.get(k) != v for k, v in stamp.items()):
+        return None
+    return slim_path
+
+def export_slim_checkpoint(model: nn.Module, checkpoint_path: str, key: str = None) -> str:
+    """
+    Write the generator weights of a training checkpoint to <epoch>.gen.pt and register it in
+    the directory's manifest.json.
+
+    The full checkpoint also holds the discriminators and optimiser states; the slim copy
+    holds only the generator's contiguous tensors and can be memory-mapped by
+    load_slim_checkpoint, so loading it costs little more than mapping the weights.
+
+    Args:
+        model (nn.Module): Model with the checkpoint's architecture.
+        checkpoint_path (str): Path of the full .pt checkpoint.
+        key (str, optional): See generator_state_dict.
+
+    Returns:
+        str: Path of the slim checkpoint.
+    """
+    slim_path = find_slim_checkpoint(checkpoint_path, model, key)
+    if slim_path is not None:
+        return slim_path
+
+    stamp = _source_stamp(checkpoint_path, model, key)
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    state_dict = generator_state_dict(checkpoint, model, key, checkpoint_path)
+    state_dict = {k: v.detach().contiguous() if isinstance(v, torch.Tensor) else v for k, v in state_dict.items()}
+
+    slim_path = slim_checkpoint_path(checkpoint_path, key)
+    tmp_path = f"{slim_path}.tmp-{os.getpid()}"
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, slim_path)
+
+    stamp.update({"format": "torch-mmap",
+                  "num_tensors": sum(isinstance(v, torch.Tensor) for v in state_dict.values()),
+                  "size": os.path.getsize(slim_path),
+                  "torch_version": torch.__version__})
+    _register(os.path.dirname(os.path.abspath(checkpoint_path)), os.path.basename(slim_path), stamp)
+    print(f"Exported generator weights of {checkpoint_path} to {slim_path} "
+          f"({stamp['size'] / 2**20:.1f} MB of {stamp['checkpoint_size'] / 2**20:.1f} MB)")
+    return slim_path
+
+def load_slim_checkpoint(slim_path: str) -> dict:
+    """State dict of a slim checkpoint, memory-mapped rather than read into memory."""
+    return torch.load(slim_path, map_location="cpu", mmap=True, weights_only=True)
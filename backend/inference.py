@@ -0,0 +1,510 @@
+import torch
+import torch.nn as nn
+
+import math
+import os
+import itertools
+import numpy as np
+from contextlib import contextmanager
+from typing import Tuple, Union
+from torch.utils.data import random_split
+
+from utils import LRUCache, prepare_device, prepare_precision
+from models import fuse_for_inference
+from data import TrainDatasetFromFolder
+from onnx_backend import load_backend
+from quantization import quantize_generator
+#%%
+# Largest safe batch per (model config, input shape, device, budget), see find_max_batch_size.
+_batch_size_cache = LRUCache(max_items=256)
+
+def _device_dtype(model):
+    """Device and dtype of the inputs `model` expects; CPU float32 for non-torch backends."""
+    param = next(model.parameters(), None) if isinstance(model, nn.Module) else None
+    device = param.device if param is not None else torch.device("cpu")
+    dtype = param.dtype if param is not None and param.is_floating_point() else torch.float32
+    return device, dtype
+
+@contextmanager
+def _eval_mode(model):
+    """Put a torch model in eval mode for the duration of the block."""
+    if not isinstance(model, nn.Module):
+        yield model
+        return
+    was_training = model.training
+    model.eval()
+    try:
+        yield model
+    finally:
+        model.train(was_training)
+
+def memory_budget(device: torch.device, fraction: float = 0.5) -> int:
+    """
+    Bytes of memory inference may use on `device`: `fraction` of what is currently free.
+
+    Args:
+        device (torch.device): Device the model runs on.
+        fraction (float): Share of the free memory to budget.
+
+    Returns:
+        int: Budget in bytes.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+    else:
+        free = None
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        free = int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+        if free is None:
+            free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return int(free * fraction)
+
+def model_signature(model: nn.Module) -> tuple:
+    """Hashable description of a model's configuration: its class and parameter/buffer shapes and dtypes."""
+    if not isinstance(model, nn.Module):
+        return (type(model).__name__, getattr(model, "signature", id(model)))
+    tensors = itertools.chain(model.named_parameters(), model.named_buffers())
+    return (type(model).__name__,) + tuple((name, tuple(t.shape), str(t.dtype)) for name, t in tensors)
+
+def estimate_sample_bytes(model: nn.Module, sample: torch.Tensor) -> int:
+    """
+    Estimate the activation memory of one input sample from a forward pass with batch size 1.
+
+    Hooks record the output size of every leaf module; the peak is taken as the input plus the
+    three largest consecutive outputs, which covers a layer's input, its output and a live
+    residual branch as in ResBlock.
+
+    Args:
+        model (nn.Module): Model in eval mode. Non-torch backends are measured on their
+            `torch_model`.
+        sample (Tensor): One input sample (1, C, H, W).
+
+    Returns:
+        int: Estimated bytes per sample.
+    """
+    model = model if isinstance(model, nn.Module) else model.torch_model
+    sizes = []
+    def hook(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            sizes.append(output.numel() * output.element_size())
+    handles = [m.register_forward_hook(hook) for m in model.modules() if not list(m.children())]
+    try:
+        with torch.inference_mode():
+            model(sample)
+    finally:
+        for handle in handles:
+            handle.remove()
+    window = max((sum(sizes[i:i + 3]) for i in range(max(len(sizes) - 2, 1))), default=0)
+    return sample.numel() * sample.element_size() + window
+
+def _is_oom(error: BaseException) -> bool:
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return ("out of memory" in message or "can't allocate memory" in message
+            or "failed to allocate memory" in message)
+
+def find_max_batch_size(model: nn.Module,
+                        sample_shape: Tuple[int, ...],
+                        budget_bytes: int = None,
+                        memory_fraction: float = 0.5,
+                        max_batch_size: int = 256) -> int:
+    """
+    Largest batch of `sample_shape` inputs the model can process within the memory budget.
+
+    The batch size is first estimated from the activation sizes of a single sample, then probed
+    with a real forward pass of that size, halving on allocation failure. Results are cached per
+    (model config, sample shape, device, requested budget), so each shape is probed once per process.
+
+    Args:
+        model (nn.Module): Model to run.
+        sample_shape (tuple): Shape of one input sample, (C, H, W).
+        budget_bytes (int, optional): Memory budget. Defaults to memory_budget(device, memory_fraction).
+        memory_fraction (float): Share of the free memory used when budget_bytes is None.
+        max_batch_size (int): Upper bound of the result.
+
+    Returns:
+        int: Batch size, at least 1.
+    """
+    device, dtype = _device_dtype(model)
+    # Keyed on the requested budget rather than the free memory at call time, which drifts.
+    budget = budget_bytes if budget_bytes is not None else ("fraction", memory_fraction)
+    key = (model_signature(model), tuple(sample_shape), str(device), str(dtype), budget, max_batch_size)
+    cached = _batch_size_cache.get(key)
+    if cached is not None:
+        return cached
+    if budget_bytes is None:
+        budget_bytes = memory_budget(device, memory_fraction)
+
+    with _eval_mode(model):
+        per_sample = estimate_sample_bytes(model, torch.zeros((1, *sample_shape), dtype=dtype, device=device))
+        batch_size = int(max(1, min(max_batch_size, budget_bytes // max(per_sample, 1))))
+        while True:
+            try:
+                with torch.inference_mode():
+                    model(torch.zeros((batch_size, *sample_shape), dtype=dtype, device=device))
+                break
+            except Exception as e:
+                # Torch raises RuntimeError/MemoryError; ONNX Runtime its own exception types.
+                if not _is_oom(e) or batch_size == 1:
+                    raise
+                batch_size //= 2
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+
+    print(f"Inference batch size for {tuple(sample_shape)}: {batch_size} "
+          f"(~{per_sample / 2**20:.1f} MB per sample, budget {budget_bytes / 2**20:.0f} MB)")
+    _batch_size_cache.put(key, batch_size)
+    return batch_size
+
+def _pair(value):
+    return tuple(value) if isinstance(value, (tuple, list)) else (value, value)
+
+def _tile_starts(length: int, tile: int, overlap: int):
+    """Origins of tiles of size `tile` covering [0, length), overlapping by at least `overlap`."""
+    if length <= tile:
+        return [0]
+    step = max(tile - overlap, 1)
+    starts = list(range(0, length - tile + 1, step))
+    if starts[-1] != length - tile:
+        starts.append(length - tile)
+    return starts
+
+def tile_window(size: int,
+                discard: Tuple[int, int] = (0, 0),
+                ramp: Tuple[int, int] = (0, 0),
+                window: str = "linear") -> torch.Tensor:
+    """
+    1D blending weights of one tile along one axis.
+
+    Args:
+        size (int): Tile size in output pixels.
+        discard (tuple): Output pixels at the (leading, trailing) edge that get zero weight, i.e.
+            the halo that only serves as context.
+        ramp (tuple): Output pixels after the discarded ones over which the weight rises to 1,
+            i.e. the part of the overlap the neighbouring tile also keeps.
+        window (str): Shape of the ramps; 'linear' and 'hann' (sin^2) ramps of two neighbours sum
+            to one, 'constant' averages the overlapping tiles.
+
+    Returns:
+        Tensor: (size,) weights, zero over the discarded pixels and positive elsewhere.
+    """
+    if window not in ("linear", "hann", "constant"):
+        raise ValueError(f"Unknown window: {window}")
+    position = torch.arange(size, dtype=torch.float64) + 0.5
+    weights = torch.ones(size, dtype=torch.float64)
+    for offset, width in zip((position - discard[0], size - discard[1] - position), ramp):
+        weights[offset < 0] = 0
+        if window != "constant" and width > 0:
+            rise = torch.clamp(offset / width, 0, 1)
+            weights *= rise if window == "linear" else torch.sin(0.5 * math.pi * rise) ** 2
+    return weights.float()
+
+def _axis_weights(starts, tile_out: int, halo_out: int, scale: float, size_out: int, window: str):
+    """Normalised window of each tile along one axis, discarding the halo at interior edges only."""
+    origins = [int(round(s * scale)) for s in starts]
+    last = len(origins) - 1
+    # Output range each tile is trusted for: the image borders have no neighbour to take over.
+    lo = [o + (halo_out if i > 0 else 0) for i, o in enumerate(origins)]
+    hi = [o + tile_out - (halo_out if i < last else 0) for i, o in enumerate(origins)]
+    windows = []
+    norm = torch.zeros(size_out)
+    for i, origin in enumerate(origins):
+        ramp = (max(hi[i - 1] - lo[i], 0) if i > 0 else 0, max(hi[i] - lo[i + 1], 0) if i < last else 0)
+        windows.append(tile_window(tile_out, (lo[i] - origin, origin + tile_out - hi[i]), ramp, window))
+        norm[origin:origin + tile_out] += windows[-1]
+    assert bool((norm > 0).all()), "Tiles do not cover the output; the halo must be below half the tile size"
+    # Pre-normalised, so tiles are blended by one fma.
+    return [w / norm[o:o + tile_out] for w, o in zip(windows, origins)]
+
+def tiled_inference(model: nn.Module,
+                    image: Union[torch.Tensor, np.ndarray],
+                    scale: Union[float, Tuple[float, float]],
+                    tile_size: Union[int, Tuple[int, int]] = 128,
+                    halo: Union[int, Tuple[int, int]] = 16,
+                    batch_size: Union[int, str] = 4,
+                    window: str = "linear",
+                    out: Union[torch.Tensor, np.ndarray] = None,
+                    memory_fraction: float = 0.5,
+                    fuse: bool = True,
+                    prepare_input=None) -> Union[torch.Tensor, np.ndarray]:
+    """
+    Apply an image-to-image model with a fixed scale factor to a 2D image tile by tile.
+
+    The image is split into tiles of `tile_size` input pixels that overlap their neighbours by
+    at least 2 * `halo`; tiles are run through the model in batches of `batch_size`. The outer
+    `halo` of every tile edge that faces a neighbour only provides context and is discarded,
+    and any overlap left after that is blended with a separable window straight into the
+    output, so each output pixel is computed with at least `halo` input pixels of context.
+    Because the tiles form a regular grid, the blending normaliser is separable too and only
+    costs two 1D vectors, so peak memory is the output plus one batch of tiles and its
+    activations.
+
+    Args:
+        model (nn.Module or OnnxRuntimeBackend): Model mapping (N, C, h, w) to
+            (N, C_out, h * scale, w * scale).
+        image (Tensor or ndarray): (H, W) or (C, H, W) input image.
+        scale (float or tuple): Output/input size ratio, per axis if a tuple.
+        tile_size (int or tuple): Tile size in input pixels; clipped to the image size.
+        halo (int or tuple): Context in input pixels discarded at each tile edge facing a
+            neighbour; clipped to below half the tile size.
+        batch_size (int or 'auto'): Tiles per forward pass; 'auto' uses find_max_batch_size.
+        window (str): Blending window, see tile_window.
+        out (Tensor or ndarray, optional): Preallocated output of shape (C_out, H*s, W*s), or
+            (H*s, W*s) for a single output channel. Allocated as a float32 tensor if None.
+        memory_fraction (float): Share of the free memory used by batch_size='auto'.
+        fuse (bool): Run a copy of the model with its BatchNorms folded into the convs
+            (models.fuse_for_inference) instead of the model itself.
+        prepare_input (callable, optional): Applied once to the batch buffer the tiles are
+            copied into, e.g. PrecisionPolicy.prepare_input to lay it out channels_last.
+
+    Returns:
+        The output, (C_out, H*s, W*s) or (H*s, W*s) if `image` is 2D.
+    """
+    image = torch.as_tensor(image)
+    squeeze = image.ndim == 2
+    if squeeze:
+        image = image.unsqueeze(0)
+    assert image.ndim == 3, "Image must be (H, W) or (C, H, W)"
+    C, H, W = image.shape
+
+    scale = _pair(scale)
+    tile = [min(t, n) for t, n in zip(_pair(tile_size), (H, W))]
+    halo = [min(h, (t - 1) // 2) for h, t in zip(_pair(halo), tile)]
+    tile_out = [t * s for t, s in zip(tile, scale)]
+    size_out = [n * s for n, s in zip((H, W), scale)]
+    for value in (*tile_out, *size_out):
+        assert math.isclose(value, round(value)), f"Tiles and image must map to whole output pixels (got {value})"
+    tile_out = [int(round(t)) for t in tile_out]
+    size_out = [int(round(n)) for n in size_out]
+
+    starts = [_tile_starts(n, t, 2 * h) for n, t, h in zip((H, W), tile, halo)]
+    weights = [_axis_weights(starts[axis], tile_out[axis], int(round(halo[axis] * scale[axis])), scale[axis],
+                             size_out[axis], window) for axis in range(2)]
+
+    device, dtype = _device_dtype(model)
+
+    if fuse and isinstance(model, nn.Module):
+        model = fuse_for_inference(model)
+    grid = [(i, j) for i in range(len(starts[0])) for j in range(len(starts[1]))]
+    if batch_size == "auto":
+        batch_size = find_max_batch_size(model, (C, tile[0], tile[1]), memory_fraction=memory_fraction,
+                                         max_batch_size=len(grid))
+    batch = torch.empty((min(batch_size, len(grid)), C, tile[0], tile[1]), dtype=dtype, device=device)
+    if prepare_input is not None:
+        batch = prepare_input(batch)
+    accumulator = None
+
+    # Only the forward pass runs in inference mode: `out` is allocated outside it, so callers get
+    # an ordinary tensor they can keep modifying in place.
+    with _eval_mode(model), torch.no_grad():
+        for first in range(0, len(grid), batch_size):
+            chunk = grid[first:first + batch_size]
+            for k, (i, j) in enumerate(chunk):
+                y, x = starts[0][i], starts[1][j]
+                batch[k].copy_(image[:, y:y + tile[0], x:x + tile[1]])
+            with torch.inference_mode():
+                pred = model(batch[:len(chunk)]).float().cpu()
+            assert tuple(pred.shape[-2:]) == tuple(tile_out), \
+                f"Model output {tuple(pred.shape[-2:])} does not match tile size {tuple(tile_out)} at scale {scale}"
+
+            if accumulator is None:
+                shape = (pred.shape[1], *size_out)
+                if out is None:
+                    out = torch.zeros(shape[1:] if squeeze and shape[0] == 1 else shape)
+                target = torch.from_numpy(out) if isinstance(out, np.ndarray) else out
+                assert target.dtype == torch.float32, "out must be float32"
+                # A view, never a copy, so strided outputs (e.g. planes of a volume) are written in place.
+                accumulator = target.unsqueeze(0) if target.ndim == 2 else target
+                assert tuple(accumulator.shape) == shape, f"out has shape {tuple(target.shape)}, expected {shape}"
+                accumulator.zero_()
+
+            for k, (i, j) in enumerate(chunk):
+                y, x = int(round(starts[0][i] * scale[0])), int(round(starts[1][j] * scale[1]))
+                accumulator[:, y:y + tile_out[0], x:x + tile_out[1]].addcmul_(
+                    pred[k], weights[0][i][:, None] * weights[1][j][None, :])
+    return out
+
+def tiled_inference_volume(model: nn.Module,
+                           volume,
+                           axis: int,
+                           scale: Union[float, Tuple[float, float]],
+                           out: np.ndarray = None,
+                           **kwargs) -> np.ndarray:
+    """
+    Apply tiled_inference to every plane of a 3D volume along `axis`.
+
+    Args:
+        model (nn.Module): Single-channel image-to-image model.
+        volume (ndarray, Tensor or LazyVolume): (D, H, W) volume; planes are read one at a time.
+        axis (int): Axis the planes are taken along.
+        scale (float or tuple): Output/input size ratio of each plane.
+        out (ndarray, optional): Preallocated output volume, e.g. a memmap. Allocated as float32 if None.
+        **kwargs: Forwarded to tiled_inference (tile_size, halo, batch_size, window, fuse,
+            prepare_input).
+
+    Returns:
+        ndarray: Output volume, with the two in-plane axes of `volume` scaled by `scale`.
+    """
+    assert volume.ndim == 3, "Volume must be 3D"
+    if kwargs.pop("fuse", True) and isinstance(model, nn.Module):
+        model = fuse_for_inference(model)
+    for index in range(volume.shape[axis]):
+        key = (slice(None),) * axis + (index,)
+        plane = np.asarray(volume[key], dtype=np.float32)
+        if out is None:
+            shape = [int(round(n * s)) for n, s in zip(plane.shape, _pair(scale))]
+            shape.insert(axis, volume.shape[axis])
+            out = np.empty(shape, dtype=np.float32)
+        tiled_inference(model, plane, scale, out=out[key], fuse=False, **kwargs)
+    return out
+
+def batched_slice_inference(model: nn.Module,
+                            volume,
+                            axis: int,
+                            batch_size: Union[int, str] = "auto",
+                            out: np.ndarray = None,
+                            memory_fraction: float = 0.5,
+                            fuse: bool = True) -> np.ndarray:
+    """
+    Run a single-channel 2D model on every slice of a volume along `axis`, several slices per pass.
+
+    Args:
+        model (nn.Module or OnnxRuntimeBackend): Model mapping (N, 1, h, w) to (N, 1, h', w').
+        volume (ndarray, Tensor or LazyVolume): (D, H, W) volume.
+        axis (int): Axis the slices are taken along.
+        batch_size (int or 'auto'): Slices per forward pass; 'auto' derives it from the memory
+            budget with find_max_batch_size.
+        out (ndarray, optional): Preallocated output volume. Allocated as float32 if None.
+        memory_fraction (float): Share of the free memory used by batch_size='auto'.
+        fuse (bool): Fold the model's BatchNorms into its convs first, see models.fuse_for_inference.
+
+    Returns:
+        ndarray: Output volume with the slices stacked along `axis`.
+    """
+    assert volume.ndim == 3, "Volume must be 3D"
+    if fuse and isinstance(model, nn.Module):
+        model = fuse_for_inference(model)
+    num_slices = volume.shape[axis]
+    slice_shape = tuple(n for k, n in enumerate(volume.shape) if k != axis)
+    if batch_size == "auto":
+        batch_size = find_max_batch_size(model, (1, *slice_shape), memory_fraction=memory_fraction,
+                                         max_batch_size=num_slices)
+
+    device, dtype = _device_dtype(model)
+    batch = torch.empty((min(batch_size, num_slices), 1, *slice_shape), dtype=dtype, device=device)
+
+    with _eval_mode(model), torch.inference_mode():
+        for first in range(0, num_slices, batch_size):
+            last = min(first + batch_size, num_slices)
+            key = (slice(None),) * axis + (slice(first, last),)
+            block = torch.from_numpy(np.ascontiguousarray(np.moveaxis(np.asarray(volume[key], dtype=np.float32), axis, 0)))
+            batch[:last - first, 0].copy_(block)
+            pred = model(batch[:last - first]).float().cpu()[:, 0].numpy()
+            if out is None:
+                shape = list(pred.shape[1:])
+                shape.insert(axis, num_slices)
+                out = np.empty(shape, dtype=np.float32)
+            np.moveaxis(out[key], axis, 0)[...] = pred
+    return out
+
+class InferenceGenerator():
+    """
+    A ready-to-run generator together with the precision and tiling it is run with.
+
+    The generator is loaded by `load` on first use, so a job that never runs it pays for no
+    checkpoint export, ONNX graph or int8 calibration.
+
+    Args:
+        load (callable): Returns the loaded, BatchNorm-folded generator (nn.Module or
+            OnnxRuntimeBackend).
+        policy (PrecisionPolicy): Autocast precision of the forward passes (utils.prepare_precision).
+        tile_size, halo, batch_size, window, memory_fraction: See tiled_inference.
+    """
+    def __init__(self, load, policy, tile_size=128, halo=16, batch_size="auto", window="linear",
+                 memory_fraction=0.5):
+        self._load = load
+        self._model = None
+        self.policy = policy
+        self.tiling = dict(tile_size=tile_size, halo=halo, batch_size=batch_size, window=window,
+                           memory_fraction=memory_fraction)
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._load()
+        return self._model
+
+    def _prepare_input(self):
+        # The input layout only matters to torch models; ONNX Runtime takes contiguous arrays.
+        return self.policy.prepare_input if isinstance(self.model, nn.Module) else None
+
+    def __call__(self, image, scale, out=None):
+        """tiled_inference of a 2D image, see there."""
+        with self.policy.autocast():
+            return tiled_inference(self.model, image, scale, out=out, fuse=False,
+                                   prepare_input=self._prepare_input(), **self.tiling)
+
+    def volume(self, volume, axis, scale, out=None):
+        """tiled_inference_volume of every plane of a 3D volume along `axis`, see there."""
+        with self.policy.autocast():
+            return tiled_inference_volume(self.model, volume, axis, scale, out=out, fuse=False,
+                                          prepare_input=self._prepare_input(), **self.tiling)
+
+def load_inference_generator(opt, build_model) -> InferenceGenerator:
+    """
+    Load the generator of an inference job as configured on its Opt, once per registry key.
+
+    The checkpoint opt.inference_checkpoint_path (entry opt.inference_checkpoint_key) is loaded
+    into build_model() on opt.inference_backend (onnx_backend.load_backend), quantised to int8
+    if opt.inference_quantization is set (quantization.quantize_generator: the input crops in
+    opt.quantization_crop_dir are split in half, to calibrate on and to compare int8 with fp32
+    on) and prepared for opt.precision / opt.channels_last. Nothing is loaded until the generator
+    is first run. With opt.model_registry set, the result is cached there under
+    opt.model_registry_key and later jobs skip all of this.
+
+    Args:
+        opt (Opt): Inference options, see /api/inference.
+        build_model (callable): Builds the untrained generator; only called on first use, on a
+            registry miss.
+
+    Returns:
+        InferenceGenerator: The generator, run with opt.inference_tile_size, opt.inference_tile_halo,
+            opt.inference_batch_size, opt.inference_window and opt.inference_memory_fraction.
+    """
+    quantization = getattr(opt, "inference_quantization", None)
+    # int8 kernels only exist on the CPU, and run in int8 whatever the autocast precision.
+    device = torch.device("cpu") if quantization else prepare_device(opt.use_cuda, opt.gpu_index)
+    policy = prepare_precision(device, "fp32" if quantization else opt.precision, opt.channels_last)
+
+    def load():
+        model = load_backend(build_model(), opt.inference_checkpoint_path, opt.inference_backend,
+                             opt.inference_intra_op_threads, opt.inference_inter_op_threads,
+                             key=getattr(opt, "inference_checkpoint_key", None))
+        if quantization:
+            assert opt.inference_backend == "torch", "int8 quantization needs the torch backend"
+            calibration = test = None
+            if os.path.isdir(opt.quantization_crop_dir):
+                # Only the inputs are used, so the folder is paired with itself.
+                crops = TrainDatasetFromFolder(opt.quantization_crop_dir, opt.quantization_crop_dir)
+                calibration, test = random_split(crops, [0.5, 0.5], generator=torch.Generator().manual_seed(0))
+            else:
+                print(f"WARNING: no crops in {opt.quantization_crop_dir} to calibrate or test int8 quantization on.")
+            model, _ = quantize_generator(model, quantization, calibration_dataset=calibration, test_dataset=test,
+                                          report_path=opt.quantization_report_path)
+        elif isinstance(model, nn.Module):
+            model = policy.prepare_model(model.to(device))
+        return model
+
+    registry = getattr(opt, "model_registry", None)
+    get = (lambda: registry.get_or_load(opt.model_registry_key, load)) if registry is not None else load
+    return InferenceGenerator(get, policy, tile_size=opt.inference_tile_size, halo=opt.inference_tile_halo,
+                              batch_size=opt.inference_batch_size, window=opt.inference_window,
+                              memory_fraction=opt.inference_memory_fraction)
@@ -0,0 +1,86 @@
+import torch.nn as nn
+
+import os
+import threading
+
+from utils import LRUCache
+#%%
+
+def model_nbytes(model) -> int:
+    """Memory footprint of a ready-to-run model: its parameters and buffers (or those of an ONNX backend's torch model plus its graph)."""
+    if not isinstance(model, nn.Module):
+        torch_model = getattr(model, "torch_model", None)
+        graph_path = getattr(model, "onnx_path", None)
+        size = os.path.getsize(graph_path) if graph_path and os.path.exists(graph_path) else 0
+        return size + (model_nbytes(torch_model) if torch_model is not None else 0)
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+class ModelRegistry():
+    """
+    Bounded LRU of ready-to-run (eval-mode) models kept in the serving process.
+
+    Models are keyed by (user, history, stage, epoch, checkpoint mtime, variant), so a
+    rewritten checkpoint is a new key and the stale entry simply ages out. The registry is
+    bounded by the summed parameter/buffer bytes of the models it holds. Concurrent requests
+    for the same missing key load the model once.
+
+    Args:
+        max_bytes (int): Memory budget of the cached models.
+        max_items (int, optional): Maximum number of cached models.
+    """
+    def __init__(self, max_bytes, max_items=None):
+        self.cache = LRUCache(max_items=max_items, max_bytes=max_bytes, sizeof=model_nbytes)
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(user_id, history_id, stage, epoch, checkpoint_path, variant=()):
+        """Registry key of a checkpoint; `variant` distinguishes loads of it (backend, quantisation, ...)."""
+        return (str(user_id), history_id, stage, int(epoch), os.stat(checkpoint_path).st_mtime_ns, tuple(variant))
+
+    def get_or_load(self, key, loader):
+        """
+        The cached model for `key`, or loader() put into eval mode and cached.
+
+        Args:
+            key (tuple): See make_key.
+            loader (callable): Builds the model and loads its checkpoint.
+
+        Returns:
+            The model.
+        """
+        model = self.cache.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                model = self.cache.get(key)
+                if model is None:
+                    model = loader()
+                    if isinstance(model, nn.Module):
+                        model.eval()
+                        for param in model.parameters():
+                            param.requires_grad_(False)
+                    self.cache.put(key, model)
+                    print(f"Model registry: loaded {key[:4]} ({model_nbytes(model) / 2**20:.1f} MB), "
+                          f"{len(self.cache)} models / {self.cache.current_bytes / 2**20:.1f} MB cached")
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        return model
+
+    def invalidate(self, user_id=None, history_id=None, stage=None):
+        """Drop the cached models matching the given user / history / stage (all if none given)."""
+        dropped = 0
+        for key in self.cache.keys():
+            if ((user_id is None or key[0] == str(user_id))
+                    and (history_id is None or key[1] == history_id)
+                    and (stage is None or key[2] == stage)):
+                dropped += self.cache.pop(key) is not None
+        return dropped
+
+    def stats(self):
+        return self.cache.stats()
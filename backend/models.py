@@ -2,11 +2,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import copy
 import functools
 import math
 from typing import Tuple
+from contextlib import contextmanager, nullcontext
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 #%%
 class ResBlock(nn.Module):
+    # (conv, bn) attribute pairs folded by fuse_for_inference.
+    _fuse_pairs_ = (('conv1', 'bn1'), ('conv2', 'bn2'))
+
     def __init__(self, inChannals, outChannals):
         super(ResBlock,self).__init__()
         
@@ -38,14 +45,29 @@ class ResBlock(nn.Module):
         return out
 
 class GeneratorSR(nn.Module):   
+    _fuse_pairs_ = (('conv2', 'bn2'),)
+    UPSAMPLERS = ('nearest', 'pixelshuffle')
+
     def __init__(
         self,
         inShape: Tuple[int, int, int],
         outShape: Tuple[int, int, int],
         baseFilters: int = 64,
         numResBlocks: int = 6,
+        upsampler: str = 'nearest',
     ):
+        """
+        upsampler: 'nearest' resamples with nn.Upsample and convolves at the output resolution;
+        'pixelshuffle' convolves at the input resolution and rearranges channels into pixels
+        with nn.PixelShuffle (nn.PixelUnshuffle when downsampling). The mode is stored in the
+        state dict, and checkpoints saved before the option existed load as 'nearest'.
+        """
         super(GeneratorSR, self).__init__()
+        if upsampler not in self.UPSAMPLERS:
+            raise ValueError(f"upsampler must be one of {self.UPSAMPLERS}, got {upsampler!r}")
+        self.upsampler = upsampler
+        self.activation_checkpointing = False
+        self.checkpoint_segments = None
         inChannels, inSize1, inSize2 = inShape
         outChannels, outSize1, outSize2 = outShape
        
@@ -90,6 +112,16 @@ class GeneratorSR(nn.Module):
         self.bn2 = nn.BatchNorm2d(baseFilters)
 
         # Upsampling blocks
+        if upsampler == 'pixelshuffle':
+            ups, in_ch = self._makeShuffleLayers_(baseFilters, int(sf), numUps, upsample=outSize1 > inSize1)
+        else:
+            ups, in_ch = self._makeNearestLayers_(baseFilters, numUps, scale_factor, final_scale)
+        self.ups = nn.Sequential(*ups)
+
+        # Final conv
+        self.finConv = nn.Conv2d(in_ch, outChannels, kernel_size=3, stride=1, padding=1)
+
+    def _makeNearestLayers_(self, baseFilters, numUps, scale_factor, final_scale):
         ups = []
         in_ch = baseFilters
         for _ in range(numUps):
@@ -106,11 +138,57 @@ class GeneratorSR(nn.Module):
             ups.append(nn.Upsample(scale_factor=final_scale, mode='nearest'))
         ups.append(nn.Conv2d(in_ch, in_ch, kernel_size=3, padding=1))
         ups.append(nn.PReLU())
-               
-        self.ups = nn.Sequential(*ups)
+        return ups, in_ch
 
-        # Final conv
-        self.finConv = nn.Conv2d(in_ch, outChannels, kernel_size=3, stride=1, padding=1)
+    def _makeShuffleLayers_(self, baseFilters, sf, numUps, upsample):
+        # sf = 2**numTwos * residual with an odd residual, which gets a single stage of its own
+        # (the counterpart of the final_scale Upsample of the nearest mode). Each stage divides
+        # the channels by factor**2, so the low-resolution conv has at most in_ch outputs and
+        # costs less than the nearest mode's conv at the high resolution, but never below the
+        # channels the nearest mode ends with (baseFilters halved numUps times), so the
+        # high-resolution features are at least as wide as there.
+        minChannels = baseFilters >> numUps
+        if minChannels < 1:
+            raise ValueError("Either increase the number of baseFilters or reduce the sf.")
+        numTwos = (sf & -sf).bit_length() - 1
+        residual = sf >> numTwos
+        factors = [2] * numTwos + ([residual] if residual > 1 else [])
+
+        ups = []
+        in_ch = baseFilters
+        for factor in factors:
+            out_ch = max(in_ch // factor ** 2, minChannels)
+            if upsample:
+                ups.append(nn.Conv2d(in_ch, out_ch * factor ** 2, kernel_size=3, padding=1))
+                ups.append(nn.PixelShuffle(factor))
+            else:
+                ups.append(nn.PixelUnshuffle(factor))
+                ups.append(nn.Conv2d(in_ch * factor ** 2, out_ch, kernel_size=3, padding=1))
+            ups.append(nn.PReLU())
+            in_ch = out_ch
+        ups.append(nn.Conv2d(in_ch, in_ch, kernel_size=3, padding=1))
+        ups.append(nn.PReLU())
+        return ups, in_ch
+
+    @staticmethod
+    def checkpoint_upsampler(state_dict, prefix=''):
+        """Upsampler mode a GeneratorSR state dict was saved with ('nearest' for old checkpoints)."""
+        return state_dict.get(prefix + '_extra_state', {}).get('upsampler', 'nearest')
+
+    def get_extra_state(self):
+        return {'upsampler': self.upsampler}
+
+    def set_extra_state(self, state):
+        upsampler = state.get('upsampler', 'nearest')
+        if upsampler != self.upsampler:
+            raise ValueError(f"Checkpoint was saved with upsampler={upsampler!r}, "
+                             f"but the model was built with upsampler={self.upsampler!r}")
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # Checkpoints from before the upsampler option carry no extra state: they are 'nearest'.
+        state_dict.setdefault(prefix + '_extra_state', {'upsampler': 'nearest'})
+        super(GeneratorSR, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                       missing_keys, unexpected_keys, error_msgs)
 
     
     def _makeLayer_(self, block, inChannals, outChannals, blocks):
@@ -128,17 +206,44 @@ class GeneratorSR(nn.Module):
         
         residual = x
         
-        out = self.resBlock(x)
+        checkpointing = self.activation_checkpointing and torch.is_grad_enabled()
+        if checkpointing:
+            out = checkpoint_sequential_(self.resBlock, self.checkpoint_segments or len(self.resBlock), x)
+        else:
+            out = self.resBlock(x)
         
         out = self.conv2(out)
         out = self.bn2(out)        
         
         out = out + residual
 
-        out = self.ups(out)
+        if checkpointing:
+            out = checkpoint_(self.ups, out)
+        else:
+            out = self.ups(out)
         
         out = self.finConv(out)
         return out    
+
+    def set_activation_checkpointing(self, enabled: bool = True, segments: int = None):
+        """
+        Trade recomputation for memory while training: with checkpointing enabled, the
+        activations inside the residual trunk and the upsampling stack are not kept for the
+        backward pass but recomputed from the segment inputs, roughly one extra forward pass of
+        those layers per step.
+
+        Args:
+            enabled (bool): Turn checkpointing on or off.
+            segments (int, optional): Number of checkpointed segments of resBlock; defaults to
+                one per residual block, which keeps the least memory.
+        """
+        self.activation_checkpointing = enabled
+        self.checkpoint_segments = segments
+        return self
+
+    def fuse_for_inference(self):
+        """Copy of the generator in eval mode with every BatchNorm folded into its conv, see fuse_for_inference."""
+        return fuse_for_inference(self)
     
 # Defines the discriminator with the specified arguments.
 class Discriminator(nn.Module):
@@ -232,6 +337,10 @@ class ResnetGenerator(nn.Module):
     def forward(self, input):
         """Standard forward"""
         return self.model(input)
+
+    def fuse_for_inference(self):
+        """Copy of the generator in eval mode with every BatchNorm folded into its conv, see fuse_for_inference."""
+        return fuse_for_inference(self)
     
 
 class ResnetBlock(nn.Module):
@@ -289,6 +398,88 @@ class ResnetBlock(nn.Module):
         """Forward function (with skip connections)"""
         out = x + self.conv_block(x)  # add skip connections
         return out
+
+@contextmanager
+def _frozen_bn_stats_(module):
+    # Recomputing a checkpointed segment must not update BatchNorm running statistics a second
+    # time. With momentum 0 a training-mode BatchNorm still normalises with the batch statistics
+    # (so the recomputed activations are identical) but leaves its running statistics as they are.
+    norms = [m for m in module.modules()
+             if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+def checkpoint_(module: nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """Run module(x) under activation checkpointing, see GeneratorSR.set_activation_checkpointing."""
+    return checkpoint(module, x, use_reentrant=False, preserve_rng_state=False,
+                      context_fn=lambda: (nullcontext(), _frozen_bn_stats_(module)))
+
+def checkpoint_sequential_(sequential: nn.Sequential, segments: int, x: torch.Tensor) -> torch.Tensor:
+    """Run an nn.Sequential as `segments` checkpointed chunks; the last chunk runs normally since its outputs are needed right away."""
+    bounds = [round(i * len(sequential) / segments) for i in range(segments + 1)]
+    for start, end in zip(bounds[:-2], bounds[1:-1]):
+        x = checkpoint_(sequential[start:end], x)
+    return sequential[bounds[-2]:bounds[-1]](x)
+
+def fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    """
+    Fold an eval-mode BatchNorm into the preceding convolution.
+
+    Args:
+        conv (nn.Conv2d): Convolution whose output feeds `bn`.
+        bn (nn.BatchNorm2d): BatchNorm with running statistics.
+
+    Returns:
+        nn.Conv2d: New convolution (with bias) equal to bn(conv(x)) in eval mode.
+    """
+    assert not (conv.training or bn.training), "Fusion is only valid in eval mode"
+    return fuse_conv_bn_eval(conv, bn)
+
+def _can_fuse_(conv, bn):
+    return (type(conv) is nn.Conv2d and isinstance(bn, nn.BatchNorm2d)
+            and bn.track_running_stats and bn.running_mean is not None)
+
+def fuse_for_inference(model: nn.Module, inplace: bool = False) -> nn.Module:
+    """
+    Copy of `model` in eval mode with every Conv2d -> BatchNorm2d pair folded into one Conv2d.
+
+    Pairs are the attributes listed in a module's `_fuse_pairs_` (ResBlock, GeneratorSR) and
+    consecutive layers of an nn.Sequential (ResnetGenerator, ResnetBlock). Folded BatchNorms are
+    replaced by nn.Identity so forward() is unchanged, and outputs match the original model in
+    eval mode up to float rounding. The returned model is for inference only: its state dict
+    no longer matches the training checkpoints.
+
+    Args:
+        model (nn.Module): Model to fuse; it is left untouched unless `inplace`.
+        inplace (bool): Fuse `model` itself instead of a copy, e.g. a freshly loaded model whose
+            weights are memory-mapped (checkpoints.load_slim_checkpoint), so that the layers
+            without a BatchNorm keep sharing the mapped file.
+
+    Returns:
+        nn.Module: The fused copy (or `model`), in eval mode.
+    """
+    model = (model if inplace else copy.deepcopy(model)).eval()
+    for module in model.modules():
+        for conv_name, bn_name in getattr(module, "_fuse_pairs_", ()):
+            conv, bn = getattr(module, conv_name), getattr(module, bn_name)
+            if _can_fuse_(conv, bn):
+                setattr(module, conv_name, fuse_conv_bn(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if _can_fuse_(module[i], module[i + 1]):
+                    module[i] = fuse_conv_bn(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
     
 if __name__ == '__main__':
 
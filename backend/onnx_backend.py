@@ -0,0 +1,213 @@
+import torch
+import torch.nn as nn
+
+import os
+import json
+import numpy as np
+from typing import Tuple
+
+from models import fuse_for_inference
+from checkpoints import generator_state_dict, export_slim_checkpoint, load_slim_checkpoint
+#%%
+ONNX_OPSET = 17
+INFERENCE_BACKENDS = ("torch", "onnxruntime")
+
+def load_checkpoint_weights(model: nn.Module, checkpoint_path: str, key: str = None, slim: bool = True) -> nn.Module:
+    """
+    Load generator weights from a training checkpoint into `model`.
+
+    See checkpoints.generator_state_dict for the accepted checkpoint layouts. With `slim`, the
+    generator's weights are exported once to a generator-only checkpoint registered in the
+    directory's manifest.json, and memory-mapped from there on every later load.
+
+    Args:
+        model (nn.Module): Model with the checkpoint's architecture.
+        checkpoint_path (str): Path of the .pt file.
+        key (str, optional): Entry of the checkpoint holding the model's state dict.
+        slim (bool): Load through the slim checkpoint (checkpoints.export_slim_checkpoint).
+
+    Returns:
+        nn.Module: `model`, with the weights loaded.
+    """
+    if slim:
+        state_dict = load_slim_checkpoint(export_slim_checkpoint(model, checkpoint_path, key))
+        # assign=True keeps the parameters backed by the mapped file instead of copying them.
+        model.load_state_dict(state_dict, assign=True)
+        return model
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    model.load_state_dict(generator_state_dict(checkpoint, model, key, checkpoint_path))
+    return model
+
+def export_onnx(model: nn.Module,
+                onnx_path: str,
+                sample_shape: Tuple[int, int, int, int] = (1, 1, 64, 64),
+                opset: int = ONNX_OPSET) -> str:
+    """
+    Export `model`, with its BatchNorms folded (models.fuse_for_inference), to an ONNX graph
+    whose batch, height and width axes are dynamic.
+
+    Args:
+        model (nn.Module): Image-to-image model, e.g. GeneratorSR.
+        onnx_path (str): Output path; written to a temporary file first and then renamed.
+        sample_shape (tuple): (N, C, H, W) shape of the example input used for tracing.
+        opset (int): ONNX opset version.
+
+    Returns:
+        str: onnx_path.
+    """
+    model = fuse_for_inference(model).cpu()
+    sample = torch.randn(*sample_shape)
+    dynamic_axes = {"input": {0: "batch", 2: "height", 3: "width"},
+                    "output": {0: "batch", 2: "height", 3: "width"}}
+    tmp_path = f"{onnx_path}.tmp-{os.getpid()}"
+    torch.onnx.export(model, (sample,), tmp_path,
+                      input_names=["input"], output_names=["output"],
+                      dynamic_axes=dynamic_axes, opset_version=opset)
+    os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+def _checkpoint_stamp(checkpoint_path: str) -> dict:
+    stat = os.stat(checkpoint_path)
+    return {"checkpoint": os.path.basename(checkpoint_path),
+            "checkpoint_mtime_ns": stat.st_mtime_ns,
+            "checkpoint_size": stat.st_size,
+            "torch_version": torch.__version__,
+            "opset": ONNX_OPSET}
+
+def export_checkpoint(model: nn.Module, checkpoint_path: str, key: str = None, **kwargs) -> str:
+    """
+    ONNX graph of a checkpoint, cached next to it as <epoch>.onnx.
+
+    A JSON sidecar (<epoch>.onnx.json) records the checkpoint's mtime and size; the graph is
+    re-exported whenever they no longer match, i.e. when the checkpoint was rewritten.
+
+    Args:
+        model (nn.Module): Model with the checkpoint's architecture.
+        checkpoint_path (str): Path of the .pt file.
+        key (str, optional): See load_checkpoint_weights.
+        **kwargs: Forwarded to export_onnx.
+
+    Returns:
+        str: Path of the .onnx file.
+    """
+    onnx_path = os.path.splitext(checkpoint_path)[0] + ".onnx"
+    meta_path = onnx_path + ".json"
+    stamp = _checkpoint_stamp(checkpoint_path)
+    if os.path.exists(onnx_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == stamp:
+                return onnx_path
+
+    export_onnx(load_checkpoint_weights(model, checkpoint_path, key), onnx_path, **kwargs)
+    with open(meta_path, "w") as f:
+        json.dump(stamp, f, indent=2)
+    print(f"Exported {checkpoint_path} to {onnx_path}")
+    return onnx_path
+
+class OnnxRuntimeBackend():
+    """
+    Runs an exported ONNX graph on the CPU with ONNX Runtime, called like the torch model.
+
+    Args:
+        onnx_path (str): Path of the graph.
+        intra_op_threads (int): Threads used inside an operator; 0 lets ONNX Runtime decide.
+        inter_op_threads (int): Threads running independent operators in parallel; 0 or 1
+            executes the graph sequentially.
+        torch_model (nn.Module, optional): The model the graph was exported from, used to
+            estimate memory use (inference.find_max_batch_size) and by verify_backend.
+    """
+    def __init__(self, onnx_path, intra_op_threads=0, inter_op_threads=0, torch_model=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnxruntime backend needs the onnxruntime package (pip install onnxruntime)")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1
+                                  else ort.ExecutionMode.ORT_SEQUENTIAL)
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.torch_model = torch_model
+        stat = os.stat(onnx_path)
+        self.signature = (onnx_path, stat.st_mtime_ns, intra_op_threads, inter_op_threads)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
+
+    def __repr__(self):
+        return f"OnnxRuntimeBackend({self.onnx_path!r})"
+
+def verify_backend(backend, model: nn.Module,
+                   sample_shapes=((1, 1, 64, 64), (2, 1, 96, 80)),
+                   rtol: float = 1e-3, atol: float = 1e-4) -> float:
+    """
+    Compare a backend's outputs with the PyTorch model's on random inputs of several shapes.
+
+    Args:
+        backend (callable): Backend to check, e.g. an OnnxRuntimeBackend.
+        model (nn.Module): Reference PyTorch model.
+        sample_shapes (sequence): (N, C, H, W) input shapes; differing H/W exercise the dynamic axes.
+        rtol, atol (float): Tolerances relative to the reference output's maximum magnitude.
+
+    Returns:
+        float: Largest absolute difference seen.
+    """
+    model = model.eval()
+    max_error = 0.0
+    with torch.inference_mode():
+        for shape in sample_shapes:
+            x = torch.randn(*shape)
+            reference = model(x).float()
+            output = backend(x).float()
+            assert output.shape == reference.shape, f"Backend output {tuple(output.shape)} != {tuple(reference.shape)}"
+            error = (output - reference).abs().max().item()
+            scale = reference.abs().max().item()
+            assert error <= atol + rtol * scale, f"Backend differs from PyTorch by {error:.3e} for input {shape}"
+            max_error = max(max_error, error)
+    print(f"{backend!r} matches PyTorch (max abs difference {max_error:.3e})")
+    return max_error
+
+def load_backend(model: nn.Module,
+                 checkpoint_path: str,
+                 backend: str = "torch",
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 key: str = None,
+                 verify: bool = True):
+    """
+    Inference callable for a checkpoint on the requested backend.
+
+    Args:
+        model (nn.Module): Model with the checkpoint's architecture.
+        checkpoint_path (str): Path of the .pt file.
+        backend (str): 'torch' (BatchNorm-folded eager model) or 'onnxruntime'.
+        intra_op_threads (int): Threads per operator (onnxruntime only); 0 keeps the default.
+            Torch's thread pool is process-wide, so the torch backend leaves it alone.
+        inter_op_threads (int): Threads across operators (onnxruntime only); 0 keeps the default.
+        key (str, optional): See load_checkpoint_weights; required if the checkpoint holds
+            several state dicts matching `model`.
+        verify (bool): Check the onnxruntime outputs against PyTorch before returning.
+
+    Returns:
+        nn.Module or OnnxRuntimeBackend: Callable on (N, C, H, W) float tensors.
+    """
+    assert backend in INFERENCE_BACKENDS, f"Unknown inference backend: {backend}"
+    if backend == "torch" and (intra_op_threads > 0 or inter_op_threads > 0):
+        raise ValueError("Thread counts only apply to the onnxruntime backend")
+    model = load_checkpoint_weights(model, checkpoint_path, key)
+    # The graph is exported (once per checkpoint) from the unfused model, which is then fused in
+    # place: a copy would read every memory-mapped weight into memory.
+    onnx_path = export_checkpoint(model, checkpoint_path, key) if backend == "onnxruntime" else None
+    fused = fuse_for_inference(model, inplace=True)
+    if backend == "torch":
+        return fused
+
+    runtime = OnnxRuntimeBackend(onnx_path, intra_op_threads, inter_op_threads, torch_model=fused)
+    if verify:
+        verify_backend(runtime, fused)
+    return runtime
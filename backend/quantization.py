@@ -0,0 +1,184 @@
+import torch
+import torch.nn as nn
+
+import os
+import json
+import time
+import numpy as np
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+from torch.utils.data import Dataset
+
+from models import fuse_for_inference
+#%%
+QUANTIZATION_MODES = ("dynamic", "static")
+
+def sample_batches(dataset: Dataset, num_samples: int = 64, batch_size: int = 8, seed: int = 0,
+                   input_scale: float = 1 / 255):
+    """
+    Yield (lr, hr) float batches of a random subset of a crop dataset.
+
+    Args:
+        dataset (Dataset): Dataset of (lr, hr) crops, e.g. TrainDatasetFromFolder or CropPackDataset.
+        num_samples (int): Number of crops drawn (without replacement).
+        batch_size (int): Crops per batch.
+        seed (int): Seed of the subset, so fp32 and int8 models see the same crops.
+        input_scale (float): Factor converting the stored crop values to model inputs.
+
+    Yields:
+        (Tensor, Tensor): (N, 1, h, w) LR inputs and (N, 1, H, W) HR targets.
+    """
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(dataset), size=min(num_samples, len(dataset)), replace=False)
+    for first in range(0, len(indices), batch_size):
+        pairs = [dataset[int(i)] for i in indices[first:first + batch_size]]
+        lr = torch.stack([torch.as_tensor(np.asarray(p[0]), dtype=torch.float32) for p in pairs])
+        hr = torch.stack([torch.as_tensor(np.asarray(p[1]), dtype=torch.float32) for p in pairs])
+        yield (lr * input_scale).unsqueeze(1), (hr * input_scale).unsqueeze(1)
+
+def quantize_dynamic_generator(model: nn.Module) -> nn.Module:
+    """
+    Dynamic post-training quantisation: int8 conv weights, activations quantised on the fly.
+
+    PyTorch's default dynamic mapping only covers Linear and recurrent layers, which the
+    generators do not have, so Conv2d is mapped to its dynamic quantised counterpart explicitly.
+    No calibration data is needed.
+    """
+    import torch.ao.nn.quantized.dynamic as nnqd
+    from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+
+    model = fuse_for_inference(model).cpu()
+    return quantize_dynamic(model, {nn.Conv2d: default_dynamic_qconfig}, mapping={nn.Conv2d: nnqd.Conv2d})
+
+def quantize_static_generator(model: nn.Module, calibration_batches, engine: str = "x86") -> nn.Module:
+    """
+    Static post-training quantisation with FX graph mode: int8 weights and activations, with
+    activation ranges observed on calibration batches.
+
+    Args:
+        model (nn.Module): fp32 model (GeneratorSR); BatchNorms are folded before quantisation.
+        calibration_batches (iterable): Input batches (N, C, h, w), e.g. the LR half of sample_batches.
+        engine (str): Quantised kernel backend, 'x86' (or 'fbgemm') on servers, 'qnnpack' on ARM.
+
+    Returns:
+        nn.Module: Quantised GraphModule taking and returning float tensors.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = engine
+    model = fuse_for_inference(model).cpu()
+    batches = iter(calibration_batches)
+    first = next(batches)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(first,))
+    with torch.inference_mode():
+        prepared(first)
+        for batch in batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+def _scores(output: torch.Tensor, target: torch.Tensor, data_range: float = None):
+    psnr, ssim = [], []
+    for pred, true in zip(output[:, 0].numpy(), target[:, 0].numpy()):
+        value_range = data_range or max(float(true.max() - true.min()), 1e-6)
+        psnr.append(peak_signal_noise_ratio(true, pred, data_range=value_range))
+        ssim.append(structural_similarity(true, pred, data_range=value_range))
+    return psnr, ssim
+
+def evaluate_quantized(fp32_model: nn.Module, int8_model: nn.Module, test_batches, data_range: float = None) -> dict:
+    """
+    PSNR/SSIM of the int8 model's outputs against the fp32 model's outputs on the same inputs,
+    and the latencies of both.
+
+    The fp32 output is the reference, so the scores measure only what quantisation changes and
+    need no ground truth (which unpaired crops, e.g. Stage2's yz/xz planes, do not have).
+
+    Args:
+        fp32_model (nn.Module): Reference model.
+        int8_model (nn.Module): Quantised model.
+        test_batches (iterable): Input batches (N, C, h, w), e.g. the LR half of sample_batches.
+        data_range (float, optional): Value range of the outputs; defaults to the range of each
+            fp32 output, since the generators' output ranges differ (e.g. tanh outputs).
+
+    Returns:
+        dict: Mean PSNR/SSIM of int8 against fp32 and seconds per crop of both.
+    """
+    models = {"fp32": fp32_model.eval(), "int8": int8_model}
+    psnr, ssim = [], []
+    elapsed = {name: 0.0 for name in models}
+    num_crops = 0
+    with torch.inference_mode():
+        for batch in test_batches:
+            num_crops += len(batch)
+            outputs = {}
+            for name, model in models.items():
+                start = time.perf_counter()
+                outputs[name] = model(batch).float()
+                elapsed[name] += time.perf_counter() - start
+            batch_psnr, batch_ssim = _scores(outputs["int8"], outputs["fp32"], data_range)
+            psnr.extend(batch_psnr)
+            ssim.extend(batch_ssim)
+
+    report = {"num_crops": num_crops,
+              "int8_vs_fp32": {"psnr": float(np.mean(psnr)), "ssim": float(np.mean(ssim))}}
+    for name in models:
+        report[name] = {"seconds_per_crop": elapsed[name] / max(num_crops, 1)}
+    report["speedup"] = report["fp32"]["seconds_per_crop"] / max(report["int8"]["seconds_per_crop"], 1e-12)
+    return report
+
+def quantize_generator(model: nn.Module,
+                       mode: str,
+                       calibration_dataset: Dataset = None,
+                       test_dataset: Dataset = None,
+                       report_path: str = None,
+                       num_calibration: int = 64,
+                       num_test: int = 64,
+                       batch_size: int = 8,
+                       input_scale: float = 1 / 255,
+                       engine: str = "x86"):
+    """
+    Quantise a trained generator to int8 for CPU inference and report its accuracy cost.
+
+    Args:
+        model (nn.Module): Trained fp32 generator, weights loaded.
+        mode (str): 'dynamic' or 'static' post-training quantisation.
+        calibration_dataset (Dataset, optional): (input, target) crops to calibrate static
+            quantisation on, e.g. the history's training crops; only the inputs are used.
+            Required for mode='static'.
+        test_dataset (Dataset, optional): (input, target) crops whose inputs the int8 model is
+            compared with the fp32 model on (see evaluate_quantized), e.g. training crops not
+            used for calibration. Without it no report is made, with a warning.
+        report_path (str, optional): Write the report there as JSON.
+        num_calibration (int): Calibration crops drawn from calibration_dataset.
+        num_test (int): Test crops drawn from test_dataset.
+        batch_size (int): Crops per batch.
+        input_scale (float): Factor converting stored crop values to model inputs.
+        engine (str): Quantised kernel backend for mode='static'.
+
+    Returns:
+        (nn.Module, dict or None): The int8 model and the report.
+    """
+    assert mode in QUANTIZATION_MODES, f"Unknown quantization mode: {mode}"
+    model = model.cpu().eval()
+    if mode == "dynamic":
+        int8_model = quantize_dynamic_generator(model)
+    else:
+        assert calibration_dataset is not None, "Static quantization needs a calibration dataset"
+        batches = (lr for lr, _ in sample_batches(calibration_dataset, num_calibration, batch_size,
+                                                  seed=1, input_scale=input_scale))
+        int8_model = quantize_static_generator(model, batches, engine=engine)
+
+    report = None
+    if test_dataset is None or len(test_dataset) == 0:
+        print(f"WARNING: no test crops, the accuracy of the int8 ({mode}) model is not reported.")
+    else:
+        batches = (lr for lr, _ in sample_batches(test_dataset, num_test, batch_size, seed=0, input_scale=input_scale))
+        report = evaluate_quantized(model, int8_model, batches)
+        report["mode"] = mode
+        print(f"int8 ({mode}) vs fp32: PSNR {report['int8_vs_fp32']['psnr']:.2f} dB, "
+              f"SSIM {report['int8_vs_fp32']['ssim']:.4f}, x{report['speedup']:.2f} faster "
+              f"on {report['num_crops']} test crops")
+        if report_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+            with open(report_path, "w") as f:
+                json.dump(report, f, indent=2)
+    return int8_model, report
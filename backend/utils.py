@@ -1,34 +1,192 @@
 
 import torch
-from torch.autograd import Variable
 
 import random
 import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
 
 import numpy as np
 #%%
 class ReplayBuffer():
+    """
+    Pool of previously generated images shown to the discriminator.
+
+    While the pool fills up, every image is stored and returned as is. Once it is full, each
+    image is swapped with probability 1/2 for a randomly chosen stored image, which is returned
+    instead; otherwise it is returned as is.
+
+    The pool is a (max_size + 1 + N, C, H, W) tensor allocated on the device of the images for
+    batches of up to N images; row max_size is a scratch slot that absorbs the writes of unswapped
+    images and the last N rows stage the incoming batch. One draw per batch decides both whether
+    and where each image is swapped, and the returned batch is gathered from the pool with one
+    index_select, so no per-image work or host synchronisation is needed on any device. Swaps of
+    a batch all see the pool as it was before the batch. `data` is never written to: the
+    returned batch is a new tensor when any image may be swapped, and `data` itself (detached)
+    while filling.
+
+    Args:
+        max_size (int): Number of images kept.
+    """
     def __init__(self, max_size=50):
         assert (max_size > 0), 'Empty buffer or trying to create a black hole. Be careful.'
         self.max_size = max_size
-        self.data = []
+        self.size = 0
+        self.data = None
+        self.staging_rows = None
 
     def push_and_pop(self, data):
-        to_return = []
-        for element in data.data:
-            element = torch.unsqueeze(element, 0)
-
-            if len(self.data) < self.max_size:
-                self.data.append(element)
-                to_return.append(element)
-            else:
-                if random.uniform(0,1) > 0.5:
-                    i = random.randint(0, self.max_size-1)
-                    to_return.append(self.data[i].clone())
-                    self.data[i] = element
-                else:
-                    to_return.append(element)
-        return Variable(torch.cat(to_return))
+        data = data.detach()
+        if self.data is None or len(self.data) < self.max_size + 1 + len(data):
+            pool = torch.empty((self.max_size + 1 + len(data),) + tuple(data.shape[1:]), dtype=data.dtype, device=data.device)
+            if self.data is not None:
+                pool[:self.size] = self.data[:self.size]
+            self.data = pool
+            self.staging_rows = torch.arange(self.max_size + 1, len(pool), device=data.device)
+
+        # Free slots are filled first; those images are returned unchanged.
+        num_fill = min(len(data), self.max_size - self.size)
+        if num_fill > 0:
+            self.data[self.size:self.size + num_fill] = data[:num_fill]
+            self.size += num_fill
+        if num_fill == len(data):
+            return data
+
+        # A draw below max_size swaps the image with that slot (probability 1/2); any other is
+        # clamped onto the scratch slot and the image is returned from its staging row.
+        incoming = data[num_fill:]
+        staging = self.staging_rows[:len(incoming)]
+        self.data[self.max_size + 1:self.max_size + 1 + len(incoming)] = incoming
+        slots = torch.randint(0, 2 * self.max_size, (len(incoming),), device=data.device).clamp_(max=self.max_size)
+        returned = self.data.index_select(0, torch.where(slots < self.max_size, slots, staging))
+        self.data.index_copy_(0, slots, incoming)
+        return torch.cat((data[:num_fill], returned)) if num_fill > 0 else returned
+
+class LRUCache():
+    """
+    Thread-safe least-recently-used cache bounded by entry count and/or total size.
+
+    Args:
+        max_items (int, optional): Maximum number of entries kept.
+        max_bytes (int, optional): Maximum summed size of the entries, as measured by `sizeof`.
+        sizeof (callable, optional): Returns the size in bytes of a value. Defaults to `nbytes`,
+            falling back to `len`.
+        on_evict (callable, optional): Called as on_evict(key, value) whenever an entry is dropped.
+    """
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None, on_evict=None):
+        assert max_items is None or max_items > 0, "max_items must be positive"
+        assert max_bytes is None or max_bytes > 0, "max_bytes must be positive"
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof is not None else _default_sizeof
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.current_bytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                old_value = self._pop(key)
+                if old_value is not value:
+                    evicted.append((key, old_value))
+            # A value larger than the whole budget is handed back to the caller uncached.
+            if self.max_bytes is None or size <= self.max_bytes:
+                self._data[key] = value
+                self._sizes[key] = size
+                self.current_bytes += size
+                while self._over_budget():
+                    old_key = next(iter(self._data))
+                    evicted.append((old_key, self._pop(old_key)))
+            if self.on_evict is not None:
+                for old_key, old_value in evicted:
+                    self.on_evict(old_key, old_value)
+        return value
+
+    def get_or_create(self, key, factory):
+        """Return the cached value for `key`, building and caching it with `factory()` on a miss."""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = self.put(key, factory())
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._pop(key)
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._data):
+                self.pop(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _pop(self, key):
+        self.current_bytes -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def _over_budget(self):
+        if self.max_items is not None and len(self._data) > self.max_items:
+            return True
+        return self.max_bytes is not None and self.current_bytes > self.max_bytes
+
+def _default_sizeof(value):
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    try:
+        return len(value)
+    except TypeError:
+        return 1
 
 class LambdaLR():
     def __init__(self, n_epochs, offset, decay_start_epoch):
@@ -48,17 +206,23 @@ def weights_init_normal(m):
         torch.nn.init.normal_(m.weight.data, 1.0, 0.02)
         torch.nn.init.constant_(m.bias.data, 0.0)
 
-def prepare_device(use_cuda: bool, gpu_index: int) -> torch.device:
+def prepare_device(use_cuda: bool, gpu_index: int, placement=None) -> torch.device:
     """
     Select and return the appropriate torch.device based on CUDA availability and user preference.
 
     Args:
         use_cuda (bool): Whether to use CUDA.
         gpu_index (int): The GPU index to use if CUDA is enabled.
+        placement (CpuPlacement or dict, optional): CPU cores, thread counts and NUMA node of
+            this job, as assigned by CpuPlacementPolicy; applied to the current process.
 
     Returns:
         torch.device: The device to be used (CPU or specific GPU).
     """
+    if placement is not None:
+        if isinstance(placement, dict):
+            placement = CpuPlacement.from_dict(placement)
+        placement.apply()
     if torch.cuda.is_available():
         if not use_cuda:
             print("WARNING: CUDA device detected, but CUDA usage is disabled. Run with --cuda to enable.")
@@ -76,6 +240,289 @@ def prepare_device(use_cuda: bool, gpu_index: int) -> torch.device:
             print("WARNING: CUDA requested but no CUDA device is available. Falling back to CPU.")
         return torch.device("cpu")
 
+def _parse_cpulist(text):
+    """CPU ids of a kernel cpulist such as '0-3,8-11'."""
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def available_cpus():
+    """CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def numa_nodes(cpus=None):
+    """Map of NUMA node id -> its CPUs among `cpus` (one node 0 holding all of them where NUMA is not exposed)."""
+    cpus = available_cpus() if cpus is None else list(cpus)
+    nodes = {}
+    root = "/sys/devices/system/node"
+    if os.path.isdir(root):
+        for entry in sorted(os.listdir(root)):
+            if entry.startswith("node") and entry[4:].isdigit():
+                with open(os.path.join(root, entry, "cpulist")) as f:
+                    node_cpus = [c for c in _parse_cpulist(f.read()) if c in cpus]
+                if node_cpus:
+                    nodes[int(entry[4:])] = node_cpus
+    return nodes or {0: cpus}
+
+def _bind_memory_to_node(node):
+    """Allocate this process's memory on NUMA node `node` only (libnuma's numa_set_membind)."""
+    import ctypes
+    import ctypes.util
+
+    path = ctypes.util.find_library("numa")
+    if path is None:
+        return False
+    libnuma = ctypes.CDLL(path)
+    if libnuma.numa_available() < 0:
+        return False
+    libnuma.numa_parse_nodestring.restype = ctypes.c_void_p
+    libnuma.numa_parse_nodestring.argtypes = [ctypes.c_char_p]
+    libnuma.numa_set_membind.argtypes = [ctypes.c_void_p]
+    libnuma.numa_bitmask_free.argtypes = [ctypes.c_void_p]
+    mask = libnuma.numa_parse_nodestring(str(node).encode())
+    if not mask:
+        return False
+    libnuma.numa_set_membind(mask)
+    libnuma.numa_bitmask_free(mask)
+    return True
+
+class CpuPlacement():
+    """
+    CPU cores, thread counts and NUMA node assigned to one job.
+
+    apply() pins the calling process and must run at the start of the job's process, before
+    its first torch operation: the OpenMP/MKL thread pools are created lazily and sized then.
+
+    Args:
+        cores (list): CPU ids the job runs on.
+        intra_op_threads (int, optional): Threads inside an operator; defaults to len(cores).
+        inter_op_threads (int): Threads running independent operators in parallel.
+        numa_node (int, optional): Bind the job's memory to this NUMA node.
+    """
+    def __init__(self, cores, intra_op_threads=None, inter_op_threads=1, numa_node=None):
+        assert len(cores) > 0, "A placement needs at least one core"
+        self.cores = sorted(int(c) for c in cores)
+        self.intra_op_threads = intra_op_threads or len(self.cores)
+        self.inter_op_threads = inter_op_threads
+        self.numa_node = numa_node
+
+    def apply(self):
+        threads = str(self.intra_op_threads)
+        os.environ["OMP_NUM_THREADS"] = threads
+        os.environ["MKL_NUM_THREADS"] = threads
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cores)
+        if self.numa_node is not None and not _bind_memory_to_node(self.numa_node):
+            print(f"WARNING: libnuma unavailable, memory not bound to NUMA node {self.numa_node}.")
+        torch.set_num_threads(self.intra_op_threads)
+        if torch.get_num_interop_threads() != self.inter_op_threads:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                print("WARNING: inter-op thread pool already started, its size is left unchanged.")
+        print(f"Using {self}")
+
+    def to_dict(self):
+        return {"cores": self.cores, "intra_op_threads": self.intra_op_threads,
+                "inter_op_threads": self.inter_op_threads, "numa_node": self.numa_node}
+
+    @classmethod
+    def from_dict(cls, placement):
+        return cls(**placement)
+
+    def __repr__(self):
+        node = f", NUMA node {self.numa_node}" if self.numa_node is not None else ""
+        return (f"CpuPlacement(cores {self.cores}, {self.intra_op_threads} intra-op / "
+                f"{self.inter_op_threads} inter-op threads{node})")
+
+class CpuPlacementPolicy():
+    """
+    Hands out disjoint CPU core sets to concurrently running jobs, so that each job sizes its
+    thread pools to its own cores instead of every job using all of them.
+
+    Each job gets cores_per_job cores, taken from a single NUMA node where one has enough
+    free cores. Once every core is taken, new jobs share the least used cores (with a
+    warning). Jobs are released explicitly or, if a process was tracked for them, as soon
+    as it has exited.
+
+    Args:
+        max_jobs (int): Number of jobs expected to run at once; sets the default cores_per_job.
+        cores_per_job (int, optional): Cores per job; defaults to the available CPUs / max_jobs.
+        inter_op_threads (int): Inter-op threads of every job.
+        bind_numa (bool): Also bind each job's memory to the NUMA node of its cores.
+        cpus (list, optional): CPUs to place jobs on; defaults to those of this process.
+    """
+    def __init__(self, max_jobs=2, cores_per_job=None, inter_op_threads=1, bind_numa=False, cpus=None):
+        self.cpus = available_cpus() if cpus is None else sorted(cpus)
+        self.nodes = numa_nodes(self.cpus)
+        self.cores_per_job = min(cores_per_job or max(1, len(self.cpus) // max_jobs), len(self.cpus))
+        self.inter_op_threads = inter_op_threads
+        self.bind_numa = bind_numa and len(self.nodes) > 1
+        self._jobs = {}
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, job_id):
+        """Assign cores to `job_id` (replacing any earlier assignment) and return its CpuPlacement."""
+        with self._lock:
+            self._reap()
+            self._jobs.pop(job_id, None)
+            load = {cpu: 0 for cpu in self.cpus}
+            for placement in self._jobs.values():
+                for cpu in placement.cores:
+                    load[cpu] = load.get(cpu, 0) + 1
+
+            # Least loaded cores of the best node, or of the whole machine if no node has enough.
+            candidates = [(node, cpus) for node, cpus in self.nodes.items() if len(cpus) >= self.cores_per_job]
+            candidates = candidates or [(None, self.cpus)]
+            best = None
+            for node, cpus in candidates:
+                cores = sorted(cpus, key=lambda cpu: (load[cpu], cpu))[:self.cores_per_job]
+                cost = sum(load[cpu] for cpu in cores)
+                if best is None or cost < best[0]:
+                    best = (cost, node, cores)
+            cost, node, cores = best
+            if cost > 0:
+                print(f"WARNING: all cores are taken, job {job_id} shares {cost} core slot(s) with running jobs.")
+
+            placement = CpuPlacement(cores, inter_op_threads=self.inter_op_threads,
+                                     numa_node=node if self.bind_numa else None)
+            self._jobs[job_id] = placement
+            return placement
+
+    def track(self, job_id, process):
+        """Release the cores of `job_id` once `process` (a multiprocessing.Process) has exited."""
+        with self._lock:
+            self._processes[job_id] = process
+
+    def release(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._processes.pop(job_id, None)
+
+    def placements(self):
+        with self._lock:
+            self._reap()
+            return dict(self._jobs)
+
+    def _reap(self):
+        for job_id, process in list(self._processes.items()):
+            if process.exitcode is not None:
+                self._jobs.pop(job_id, None)
+                del self._processes[job_id]
+
+PRECISIONS = ("fp32", "bf16", "fp16", "auto")
+
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX), where bf16 autocast pays off."""
+    try:
+        if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            return True
+    except (AttributeError, RuntimeError):
+        pass
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+class PrecisionPolicy():
+    """
+    Numeric precision and memory layout used to run the models on a device.
+
+    Use `autocast()` around forward passes and loss computations, `prepare_model` and
+    `prepare_input` for the channels_last layout, and `scaler` for backward/optimizer steps:
+    it scales the loss only for fp16 on CUDA, where gradients can underflow, and passes
+    through otherwise (bf16 has the fp32 exponent range and needs no loss scaling).
+
+    Args:
+        device (torch.device): Device the models run on.
+        precision (str): 'fp32', 'bf16', 'fp16' or 'auto' (bf16 where the CPU supports it,
+            fp16 on CUDA, fp32 otherwise). Unsupported requests fall back to fp32 with a warning.
+        channels_last (bool): Run convolutions in the NHWC memory layout.
+    """
+    def __init__(self, device: torch.device, precision: str = "fp32", channels_last: bool = False):
+        assert precision in PRECISIONS, f"Unknown precision: {precision}"
+        self.device = torch.device(device)
+        cuda = self.device.type == "cuda"
+        if precision == "auto":
+            precision = "fp16" if cuda else ("bf16" if cpu_supports_bf16() else "fp32")
+        elif precision == "bf16" and not cuda and not cpu_supports_bf16():
+            print("WARNING: bf16 requested but the CPU has no native bf16 support. Falling back to fp32.")
+            precision = "fp32"
+        elif precision == "fp16" and not cuda:
+            print("WARNING: fp16 autocast is only used on CUDA. Falling back to fp32.")
+            precision = "fp32"
+        self.precision = precision
+        self.dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+        self.channels_last = channels_last
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=(precision == "fp16" and cuda))
+
+    def autocast(self):
+        if self.precision == "fp32":
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def prepare_model(self, model):
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_input(self, x):
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def __repr__(self):
+        layout = "channels_last" if self.channels_last else "contiguous"
+        return f"PrecisionPolicy({self.precision}, {layout}, {self.device})"
+
+def prepare_precision(device: torch.device, precision: str = "fp32", channels_last: bool = False) -> PrecisionPolicy:
+    """
+    Select the precision/layout policy for a job, next to prepare_device.
+
+    Args:
+        device (torch.device): Device returned by prepare_device.
+        precision (str): See PrecisionPolicy.
+        channels_last (bool): See PrecisionPolicy.
+
+    Returns:
+        PrecisionPolicy: The policy actually applied on this machine.
+    """
+    policy = PrecisionPolicy(device, precision, channels_last)
+    print(f"Using {policy}")
+    return policy
+
+class EpochTimer():
+    """
+    Measures and logs the wall time and throughput of training epochs.
+
+    Args:
+        label (str): Printed with every epoch, e.g. the precision policy.
+    """
+    def __init__(self, label=""):
+        self.label = label
+        self.times = []
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def stop(self, epoch, num_samples=None):
+        elapsed = time.perf_counter() - self._start
+        self.times.append(elapsed)
+        rate = f", {num_samples / elapsed:.1f} samples/s" if num_samples else ""
+        print(f"Epoch {epoch}: {elapsed:.1f}s{rate} [{self.label}]")
+        return elapsed
+
 def prepare_seed(seed):
     """Set all random seeds for reproducibility."""
 
@@ -89,4 +536,13 @@ def prepare_seed(seed):
     # # Ensure deterministic behavior in cuDNN (important for reproducibility)
     # torch.backends.cudnn.deterministic = True
     # torch.backends.cudnn.benchmark = False
-    return seed    
\ No newline at end of file
+    return seed    
+
+def seed_worker(worker_id):
+    """
+    DataLoader worker_init_fn that reseeds every RNG of a worker through prepare_seed.
+
+    Each worker gets torch's per-worker seed (the loader's base seed + worker_id), so random
+    crops differ between workers and epochs but replay identically for a fixed prepare_seed.
+    """
+    prepare_seed(torch.initial_seed() % 2**32)